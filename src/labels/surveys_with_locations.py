@@ -1,35 +1,136 @@
 import sys
 import os
+import io
+import json
+import hashlib
 import zipfile
-import shutil
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Add the project root to the system path
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
 if project_root not in sys.path:
     sys.path.append(project_root)
 
-from src.utils.utils import get_data_root, save_data
+from src.utils.utils import get_data_root, save_data, file_hash, cached_file_hash, load_manifest, save_manifest
 
-def generate_surveys(survey_name, sample_group):
+PROPERTIES_FILE = "project_definition.properties"
+MANIFEST_FILE = "survey_manifest.json"
+
+# Everything other than the template and the sample that goes into a survey. Changing any of these (or bumping
+# the version after changing how surveys are built) regenerates every survey.
+SURVEY_SETTINGS = {"distance_to_plot_boundaries": 500, "version": 1}
+
+@lru_cache(maxsize=None)
+def _load_template(template_zip_path, modified_time):
+    """
+    Read a survey template once and cache it (the modification time is part of the cache key, so an edited
+    template is read again).
+
+    Returns:
+        (bytes, list[str]): An in-memory zip of every template member except project_definition.properties,
+            and the lines of project_definition.properties.
     """
-    For each sample in the sample group without an associated survey,
-    generate a survey with modified project properties.
+    base = io.BytesIO()
+    properties = None
+    with zipfile.ZipFile(template_zip_path, 'r') as template, zipfile.ZipFile(base, 'w') as zipf:
+        for info in template.infolist():
+            if info.filename == PROPERTIES_FILE:
+                properties = template.read(info).decode("utf-8").splitlines(keepends=True)
+            else:
+                zipf.writestr(info, template.read(info), compress_type=info.compress_type)
+    if properties is None:
+        raise FileNotFoundError(f"The survey template {template_zip_path} has no {PROPERTIES_FILE}.")
+    return base.getvalue(), properties
+
+def settings_hash():
+    """Return a hash of SURVEY_SETTINGS."""
+    return hashlib.sha256(json.dumps(SURVEY_SETTINGS, sort_keys=True).encode()).hexdigest()
+
+def generate_surveys(survey_name, sample_group, n_workers=1, dry_run=False):
+    """
+    For each sample in the sample group, generate a survey with modified project properties if there is none yet
+    or if its inputs changed.
+
+    A survey is regenerated when its zip is missing, it is not in the manifest (survey_manifest.json in the survey
+    group folder), or the hash of the template, the sample or the settings differs from the one in the manifest.
+    Samples are only hashed again when their size or modification time changed, so checking a group of hundreds
+    of samples is quick.
+
+    Parameters:
+        survey_name (str): Name of the survey template zip file.
+        sample_group (str): Name of the sample group directory.
+        n_workers (int): Number of surveys to generate at the same time.
+        dry_run (bool): Only report which surveys would be generated and why.
+
+    Returns:
+        list[str]: The samples whose surveys were (or, for a dry run, would be) generated.
     """
     data_root = get_data_root()
     survey_template_path = os.path.join(data_root, "labels/survey_template", survey_name)
     sample_group_path = os.path.join(data_root, "sampling/samples", sample_group)
     survey_group_path = os.path.join(data_root, "labels/unlabeled_surveys", sample_group)
 
-    samples = [s.removesuffix(".csv") for s in os.listdir(sample_group_path) if s.endswith('.csv')]
+    samples = sorted(s.removesuffix(".csv") for s in os.listdir(sample_group_path) if s.endswith('.csv'))
+    # Records for each generated survey the hashes of the template, sample and settings it was generated from:
+    # {sample: {"template": ..., "sample": ..., "settings": ..., "sample_mtime": ..., "sample_size": ...}}
+    manifest_path = os.path.join(survey_group_path, MANIFEST_FILE)
+    manifest = load_manifest(manifest_path)
+    template = file_hash(survey_template_path)
+    settings = settings_hash()
 
+    to_generate = {}
     for sample in samples:
         output_zip_path = os.path.join(survey_group_path, f"{sample}.zip")
-        if os.path.exists(output_zip_path):
-            print(f"Survey for {sample} already exists. Skipping.")
+        entry = manifest.get(sample)
+
+        # Reuse the recorded hash of the sample if the file looks unchanged
+        known = entry and {"mtime": entry.get("sample_mtime"), "size": entry.get("sample_size"), "hash": entry["sample"]}
+        sample_file = cached_file_hash(os.path.join(sample_group_path, f"{sample}.csv"), known)
+        sample_hash = sample_file["hash"]
+
+        if not os.path.exists(output_zip_path):
+            reason = "no survey"
+        elif entry is None:
+            reason = "not in manifest"
+        elif entry["template"] != template:
+            reason = "template changed"
+        elif entry["sample"] != sample_hash:
+            reason = "sample changed"
+        elif entry["settings"] != settings:
+            reason = "settings changed"
+        else:
+            print(f"Survey for {sample} is up to date. Skipping.")
+            entry.update(sample_mtime=sample_file["mtime"], sample_size=sample_file["size"])
             continue
 
-        print(f"Generating survey for {sample}")
-        generate_survey(survey_template_path, survey_group_path, sample_group_path, sample)
+        to_generate[sample] = (reason, {
+            "template": template, "sample": sample_hash, "settings": settings,
+            "sample_mtime": sample_file["mtime"], "sample_size": sample_file["size"],
+        })
+
+    if dry_run:
+        for sample, (reason, _) in to_generate.items():
+            print(f"Would generate survey for {sample} ({reason})")
+        print(f"{len(to_generate)} of {len(samples)} surveys would be generated.")
+        return list(to_generate)
+
+    # Writing a survey is mostly file I/O and zlib, which release the GIL, so threads are enough
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {}
+            for sample, (reason, _) in to_generate.items():
+                print(f"Generating survey for {sample} ({reason})")
+                futures[executor.submit(generate_survey, survey_template_path, survey_group_path, sample_group_path, sample)] = sample
+            for future in as_completed(futures):
+                future.result()
+                sample = futures[future]
+                manifest[sample] = to_generate[sample][1]
+    finally:
+        # Record the surveys that were generated, even if another one failed
+        save_manifest(manifest_path, manifest)
+
+    return list(to_generate)
 
 
 def generate_survey(template_zip_path, output_dir, sample_dir, sample_name):
@@ -42,59 +143,44 @@ def generate_survey(template_zip_path, output_dir, sample_dir, sample_name):
         csv=${project_path}/'the sample's name'
     This file will have the same name as the sample it contains. 
 
+    The template is read once and cached. Its unchanged members are copied into the survey as they are (without
+    extracting or recompressing them), and only the properties file and the sample are added.
+
     Parameters:
-        survey_path (str): Path to the Open Foris Collect survey file.
-        sample_group_path (str): Path to the sample group.
-        sample (str): Sample name to generate the survey for.
+        template_zip_path (str): Path to the Open Foris Collect survey file.
+        output_dir (str): Folder to write the survey to.
+        sample_dir (str): Path to the sample group.
+        sample_name (str): Sample name to generate the survey for.
     """
-    temp_dir = os.path.join(output_dir, f"temp_{sample_name}")
-    os.makedirs(temp_dir, exist_ok=True)
-
-    # Unzip template into temp_dir
-    with zipfile.ZipFile(template_zip_path, 'r') as zip_ref:
-        zip_ref.extractall(temp_dir)
-
-    prop_path = os.path.join(temp_dir, "project_definition.properties")
+    base, properties = _load_template(template_zip_path, os.path.getmtime(template_zip_path))
 
     # Desired values
-    distance_line = "distance_to_plot_boundaries=500\n"
+    distance_line = f"distance_to_plot_boundaries={SURVEY_SETTINGS['distance_to_plot_boundaries']}\n"
     csv_line = f"csv=${{project_path}}/{sample_name}.csv\n"
 
-    # Read original lines
-    with open(prop_path, 'r') as f:
-        lines = f.readlines()
-
     # Replace lines if they exist
     new_lines = []
-    for line in lines:
+    for line in properties:
         if line.startswith("distance_to_plot_boundaries="):
             new_lines.append(distance_line)
-            found_distance = True
         elif line.startswith("csv="):
             new_lines.append(csv_line)
-            found_csv = True
         else:
             new_lines.append(line)
 
-    # Write updated file
-    with open(prop_path, 'w') as f:
-        f.writelines(new_lines)
-
-    # Copy the sample file into the directory
-    sample_file_path = os.path.join(sample_dir, f"{sample_name}.csv")
-    shutil.copy(sample_file_path, os.path.join(temp_dir, f"{sample_name}.csv"))
+    # Add the properties file and the sample to a copy of the template
+    survey = io.BytesIO(base)
+    survey.seek(0, io.SEEK_END)
+    with zipfile.ZipFile(survey, 'a', zipfile.ZIP_DEFLATED) as zipf:
+        zipf.writestr(PROPERTIES_FILE, "".join(new_lines))
+        zipf.write(os.path.join(sample_dir, f"{sample_name}.csv"), f"{sample_name}.csv")
 
-    # Zip everything in temp_dir into the final zip
+    os.makedirs(output_dir, exist_ok=True)
     output_zip_path = os.path.join(output_dir, f"{sample_name}.zip")
-    with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for foldername, _, filenames in os.walk(temp_dir):
-            for filename in filenames:
-                file_path = os.path.join(foldername, filename)
-                arcname = os.path.relpath(file_path, temp_dir)
-                zipf.write(file_path, arcname)
-
-    # Clean up
-    shutil.rmtree(temp_dir)
+    # Write to a temporary file first so an interrupted run cannot leave a partial survey that would be skipped later
+    with open(output_zip_path + ".tmp", 'wb') as f:
+        f.write(survey.getvalue())
+    os.replace(output_zip_path + ".tmp", output_zip_path)
     print(f"Survey for {sample_name} written to {output_zip_path}")
 
 
@@ -112,5 +198,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate surveys for a sample group.")
     parser.add_argument("--survey_name", type=str, help="Name of the survey template zip file.")
     parser.add_argument("--sample_group", type=str, help="Name of the sample group directory.")
+    parser.add_argument("--n_workers", type=int, default=1, help="Number of surveys to generate at the same time.")
+    parser.add_argument("--dry_run", action="store_true", help="Only report which surveys would be generated.")
     args = parser.parse_args()
-    generate_surveys(args.survey_name, args.sample_group)
+    generate_surveys(args.survey_name, args.sample_group, n_workers=args.n_workers, dry_run=args.dry_run)
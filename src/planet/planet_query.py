@@ -14,8 +14,16 @@ import json
 with open('planet_api_key', 'r') as f:
     api_key = f.read().strip()
 
-def fix_geometry_coordinates(geometry):
-    """Fix coordinate order from [lat, lon] to [lon, lat]"""
+def fix_geometry_coordinates(geometry, lon, lat):
+    """
+    Fix coordinate order from [lat, lon] to [lon, lat].
+
+    Older versions of pool_latest_labels.py wrote the boxes with latitude and longitude swapped, newer ones write
+    them in [lon, lat]. The box is only swapped if its center is closer to (lat, lon) than to (lon, lat).
+    """
+    center = shape(geometry).centroid
+    if abs(center.x - lon) + abs(center.y - lat) <= abs(center.x - lat) + abs(center.y - lon):
+        return geometry
     if geometry['type'] == 'Polygon':
         fixed_coords = [[[coord[1], coord[0]] for coord in ring] for ring in geometry['coordinates']]
         return {
@@ -69,7 +77,7 @@ def select_evenly_spaced_images(items, n_desired=36):
 
 async def search_single_feature(client, feature_idx, row, total_features, pbar, n_desired, max_cloud_cover):
     """Search Planet imagery for a single feature"""
-    geometry = fix_geometry_coordinates(mapping(row.geometry))
+    geometry = fix_geometry_coordinates(mapping(row.geometry), row['x'], row['y'])
     
     feature_date = datetime(
         year=int(row['year']),
@@ -1,19 +1,113 @@
 import os
-from survey_to_csv import process_xml_zip
-from polygons_to_geojson import kml_to_geojson
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from survey_to_csv import process_xml_zip, default_location_file
+from polygons_to_geojson import kml_to_geojson, polygons_path, find_polygons
 import pandas as pd
 from merge_survey_and_polygons import merge_and_check
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))) # Add src to the path so utils can be found
+from utils.geometries import get_site_box_cache
+from utils.utils import cached_file_hash, load_manifest, save_manifest
 
 # process a folder full of completed surveys
 
-def process_and_merge_folder(folder_path):
+# Records what every processed and merged file was built from, in the survey group folder (next to raw/)
+BUILD_MANIFEST_FILE = "build_manifest.json"
+
+# Bump the version after changing how files are processed or merged to rebuild everything
+BUILD_SETTINGS = {"certainty_cutoff": 3, "version": 1}
+
+STAGES = ["surveys", "polygons", "merge"]
+
+def input_hashes(paths, manifest):
+    """
+    Return the hash of each input file that exists. Files are only hashed again when their size or modification
+    time changed since they were last hashed (manifest["files"] keeps the hash of every input).
+    """
+    hashes = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        manifest["files"][path] = cached_file_hash(path, manifest["files"].get(path))
+        hashes[path] = manifest["files"][path]["hash"]
+    return hashes
+
+def plan_task(manifest, stage, outputs, inputs, settings, args, force=False):
+    """
+    Return a build task if any output is missing or the inputs or settings changed since it was last built,
+    otherwise None.
+    """
+    record = {"inputs": input_hashes(inputs, manifest), "settings": settings}
+    if not force and all(os.path.exists(output) for output in outputs) and manifest["outputs"].get(outputs[0]) == record:
+        return None
+    return {"stage": stage, "outputs": outputs, "record": record, "args": args}
+
+def run_task(stage, args):
+    """Run one build step and return how long it took in seconds."""
+    start = time.perf_counter()
+    if stage == "surveys":
+        process_xml_zip(*args)
+    elif stage == "polygons":
+        kml_to_geojson(*args)
+    else:
+        merge_and_check(*args)
+    return time.perf_counter() - start
+
+def run_tasks(tasks, manifest, manifest_path, n_workers, timings):
+    """
+    Run independent build tasks (in n_workers processes), recording each one in the manifest as soon as it is
+    done, so a failed or interrupted run only rebuilds what did not finish. The time spent in each task is added
+    to timings[stage]["work"].
+    """
+    def done(task, seconds):
+        manifest["outputs"][task["outputs"][0]] = task["record"]
+        timings[task["stage"]]["work"] += seconds
+
+    try:
+        if n_workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = {executor.submit(run_task, task["stage"], task["args"]): task for task in tasks}
+                for future in as_completed(futures):
+                    done(futures[future], future.result())
+        else:
+            for task in tasks:
+                done(task, run_task(task["stage"], task["args"]))
+    finally:
+        save_manifest(manifest_path, manifest)
+
+def cache_survey_boxes(survey_files, box_cache_path):
+    """
+    Add the survey box of every site in survey_files to the site box cache and save it once. Used before merging in
+    worker processes, which then do not need to save the cache themselves.
+    """
+    box_cache = get_site_box_cache(box_cache_path)
+    for survey_file in survey_files:
+        survey = pd.read_csv(survey_file, usecols=["site_id", "x", "y"])
+        box_cache.boxes(survey["site_id"], survey["y"], survey["x"])
+    box_cache.save()
+
+def print_summary(timings, convert_time, merge_time, n_workers):
+    """Print how many files each stage rebuilt and how long it took."""
+    print("----- BUILD SUMMARY -----")
+    for stage in STAGES:
+        stage_timings = timings[stage]
+        print(f"{stage:<9} {stage_timings['built']:>4} of {stage_timings['total']:>4} rebuilt, {stage_timings['work']:7.2f} s of work")
+    print(f"Converting took {convert_time:.2f} s and merging {merge_time:.2f} s "
+          f"({convert_time + merge_time:.2f} s in total, {n_workers} worker{'s' if n_workers > 1 else ''})")
+
+def process_and_merge_folder(folder_path, polygon_format="geojson", box_cache_path=None, n_workers=1, force=False):
     """
     Processes and merges all raw survey maching polygon files in a specified folder.
-    This function iterates through all files in the given folder, processes
-    `.kml` and `.zip` files using specific helper functions, and merges the
-    resulting processed `.csv` files into a single DataFrame.
+    This function converts the `.kml` and `.zip` files in the given folder using specific helper
+    functions, merges every processed survey with its polygons, and combines the merged `.csv`
+    files into a single DataFrame. Like make, it only rebuilds outputs that are out of date.
     Args:
         folder_path (str): The path to the folder containing the files to process.
+        polygon_format (str): Format to write the processed polygons in (geojson, parquet or fgb).
+        box_cache_path (str, optional): Parquet file to persist the survey box of each site in between runs.
+        n_workers (int): Number of processes to convert and merge independent files in.
+        force (bool): Rebuild every output, even if it is up to date.
     Returns:
         pandas.DataFrame: A DataFrame containing the merged results of all processed `.csv` files.
     Notes:
@@ -21,22 +115,65 @@ def process_and_merge_folder(folder_path):
         - `.zip` files are processed using the `process_xml_zip` function.
         - The processed files are expected to be stored in a subfolder named "processed".
         - Only `.csv` files in the "processed" folder are merged.
+        - A processed file is rebuilt when it is missing or the hash of its raw file (and, for surveys, of the
+          sample it was generated from) changed. A merged file is rebuilt when it is missing or the hash of its
+          processed survey or polygons changed. The hashes are kept in `build_manifest.json` next to the raw
+          folder, and files are only hashed again when their size or modification time changed.
+        - Each stage runs its out of date files in parallel, and a timing summary is printed at the end.
     Raises:
         FileNotFoundError: If the specified folder or required files do not exist.
         ValueError: If there are issues during the merging process.
     """
+    folder_path = os.path.normpath(folder_path)
+    group_path = os.path.dirname(folder_path)
+    processed_path = folder_path.replace("/raw", "/processed")
+    merged_path = folder_path.replace("/raw", "/merged")
+    # {"outputs": {output: {"inputs": {path: hash}, "settings": ...}}, "files": {path: {"mtime": ..., "size": ..., "hash": ...}}}
+    manifest_path = os.path.join(group_path, BUILD_MANIFEST_FILE)
+    manifest = load_manifest(manifest_path, {"outputs": {}, "files": {}})
+    timings = {stage: {"built": 0, "total": 0, "work": 0.0} for stage in STAGES}
 
+    def plan(tasks, stage, outputs, inputs, args):
+        timings[stage]["total"] += 1
+        task = plan_task(manifest, stage, outputs, inputs, BUILD_SETTINGS, args, force)
+        if task:
+            timings[stage]["built"] += 1
+            tasks.append(task)
 
-    for file_name in os.listdir(folder_path):
+    # Convert the raw surveys and polygons, which are all independent of each other
+    start = time.perf_counter()
+    tasks = []
+    for file_name in sorted(os.listdir(folder_path)):
         file_path = os.path.join(folder_path, file_name)
         if file_name.endswith('.kml'):
-            kml_to_geojson(file_path)
+            output = polygons_path(os.path.join(processed_path, file_name), polygon_format)
+            plan(tasks, "polygons", [output], [file_path], (file_path, polygon_format))
         elif file_name.endswith('.zip'):
-            process_xml_zip(file_path)
+            output = os.path.join(processed_path, file_name.replace(".zip", ".csv"))
+            plan(tasks, "surveys", [output], [file_path, default_location_file(file_path)], (file_path,))
+    run_tasks(tasks, manifest, manifest_path, n_workers, timings)
+    convert_time = time.perf_counter() - start
 
-    # Merge the processed files
-    processed_path = folder_path.replace("/raw", "/processed")
-    merged_result = [merge_and_check(os.path.join(processed_path, file)) for file in os.listdir(processed_path) if file.endswith('.csv')]
+    # Merge each processed survey with its polygons. Worker processes would all save the site box cache, so with
+    # more than one worker the boxes are cached and saved once here and the workers do not use the cache file.
+    start = time.perf_counter()
+    survey_files = sorted(file for file in os.listdir(processed_path) if file.endswith('.csv'))
+    worker_box_cache_path = box_cache_path if n_workers == 1 else None
+    tasks = []
+    for file in survey_files:
+        survey_file = os.path.join(processed_path, file)
+        outputs = [os.path.join(merged_path, file.replace(".csv", suffix)) for suffix in ["_merged.csv", "_report.txt"]]
+        args = (survey_file, None, BUILD_SETTINGS["certainty_cutoff"], worker_box_cache_path)
+        plan(tasks, "merge", outputs, [survey_file, find_polygons(survey_file)], args)
+    if box_cache_path and n_workers > 1 and tasks:
+        cache_survey_boxes([task["args"][0] for task in tasks], box_cache_path)
+    run_tasks(tasks, manifest, manifest_path, n_workers, timings)
+    merge_time = time.perf_counter() - start
+
+    print_summary(timings, convert_time, merge_time, n_workers)
+
+    # Combine the merged files (read from disk, so up to date files do not need to be merged again)
+    merged_result = [pd.read_csv(os.path.join(merged_path, file.replace(".csv", "_merged.csv"))) for file in survey_files]
     merged_result = pd.concat(merged_result, ignore_index=True)
     return merged_result
 
@@ -54,9 +191,13 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Process and merge all survey files in a folder.")
     parser.add_argument("folder_path", type=str, help="Path to the folder containing survey files.")
+    parser.add_argument("--polygon_format", type=str, default="geojson", help="Format of the processed polygons: geojson, parquet or fgb.")
+    parser.add_argument("--box_cache", type=str, default=None, help="Parquet file to cache the survey box of each site in between runs.")
+    parser.add_argument("--n_workers", type=int, default=1, help="Number of processes to convert and merge independent files in.")
+    parser.add_argument("--force", action="store_true", help="Rebuild every processed and merged file, even if it is up to date.")
     args = parser.parse_args()
     folder_path = args.folder_path
 
-    merged_result = process_and_merge_folder(folder_path)
+    merged_result = process_and_merge_folder(folder_path, args.polygon_format, args.box_cache, args.n_workers, args.force)
 
     print(f"Merged result has {len(merged_result)} rows")
\ No newline at end of file
@@ -1,12 +1,17 @@
 import pandas as pd
 import geopandas as gpd
-from shapely.ops import unary_union
+import numpy as np
+import shapely
 from typing import Optional
-from shapely.validation import make_valid
 import os
 import sys
+import pyproj
+from functools import lru_cache
+from collections import defaultdict
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))) # Add src to the path so utils can be found
-from utils.geometries import survey_polygon
+from utils.geometries import get_site_box_cache
+from processing.polygons_to_geojson import find_polygons, read_polygons
+from sampling.make_grid import get_utm_crs
 
 def check_irrigation_polygon_consistency(row, matching_polys, irrigation, idx):
     """
@@ -30,10 +35,73 @@ def check_irrigation_polygon_consistency(row, matching_polys, irrigation, idx):
             issues.append(f"Row {idx} (internal_id {row['internal_id']}, {row['day']}/{row['month']}/{row['year']}): survey marked irrigation {irrigation} (uncertain) but found a polygon with certainty 5 (certain).")
     return issues
 
-def process_survey_row(row, polygons, certainty_cutoff, idx):
+def build_polygon_index(polygons):
     """
-    Processes a single survey row: matches polygons, computes coverage and stats, and returns results and report lines.
-    Returns (result_dict, report_lines), where the results include: 
+    Group the polygons by (internal_id, year, month, day) so that the polygons of a survey row are found with a
+    dictionary lookup instead of a scan over all polygons.
+    Returns a dict from key to the positions of the matching polygons, in order.
+    """
+    polygon_index = defaultdict(list)
+    keys = zip(polygons["internal_id"].tolist(), polygons["year"].tolist(), polygons["month"].tolist(), polygons["day"].tolist())
+    for position, key in enumerate(keys):
+        polygon_index[key].append(position)
+    return polygon_index
+
+def match_polygons(row, polygon_index):
+    """
+    Returns the positions of the polygons that match a survey row by internal_id (or site_id if the labeler
+    accidentally used that), year, month, and day, in the order of the polygons.
+    """
+    date = (row["year"], row["month"], row["day"])
+    positions = set(polygon_index.get((row["internal_id"], *date), []))
+    positions.update(polygon_index.get((int(row["site_id"][3:]), *date), []))
+    return sorted(positions)
+
+SPECIAL_CATEGORIES = ["plantation", "industrial", "lawn", "covered"]
+
+@lru_cache(maxsize=None)
+def utm_transformer(epsg_code):
+    """Returns a (cached) transformer from lon/lat to the given UTM zone."""
+    return pyproj.Transformer.from_crs("EPSG:4326", f"EPSG:{epsg_code}", always_xy=True)
+
+def utm_epsg_codes(lons, lats):
+    """Returns the EPSG code of the UTM zone of each location (see make_grid.get_utm_crs), looking up each distinct location once."""
+    locations = pd.DataFrame({"lon": np.asarray(lons, dtype=float), "lat": np.asarray(lats, dtype=float)})
+    distinct = locations.drop_duplicates()
+    codes = {(lon, lat): get_utm_crs(lon, lat).to_epsg() for lon, lat in zip(distinct["lon"], distinct["lat"])}
+    return np.array([codes[location] for location in zip(locations["lon"], locations["lat"])], dtype=np.int64)
+
+def project_to_utm(geometries, epsg_codes):
+    """
+    Projects lon/lat geometries to UTM, each to the zone given by its EPSG code (geometries with code 0 are left
+    as they are). All geometries of a zone are transformed in one call with a cached transformer.
+    """
+    projected = np.array(geometries, dtype=object, copy=True)
+    for epsg_code in np.unique(epsg_codes):
+        if epsg_code == 0:
+            continue
+        in_zone = epsg_codes == epsg_code
+        transformer = utm_transformer(int(epsg_code))
+        projected[in_zone] = shapely.transform(geometries[in_zone], lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+    return projected
+
+def coverage_statistics(survey_geometries, polygons, matches, certainty_cutoff, survey_epsg_codes):
+    """
+    Computes the coverage and polygon size statistics of every survey row of a file in batched shapely calls.
+
+    Polygons are made valid once for the whole file. Survey areas and polygons are then projected once to the UTM
+    zone of their site, and all areas and coverages are computed from the projected geometries. Unions are cached by the set of polygons they cover, so the
+    union of a row's polygons is computed once and reused for nested filters that keep the same polygons (e.g. when
+    all polygons are high certainty, or all high-certainty polygons are plantations), and for rows that share the
+    same polygons. The intersections with the survey areas are then computed for all rows at once.
+
+    Args:
+        survey_geometries (np.ndarray): Survey area of each row.
+        polygons (gpd.GeoDataFrame): All polygons of the file.
+        matches (list[list[int]]): Positions of the polygons matching each row (see match_polygons).
+        certainty_cutoff (int): How high does an irrigation certainty need to be to be considered "high certainty"?
+        survey_epsg_codes (np.ndarray): EPSG code of the UTM zone of each row (see utm_epsg_codes).
+    Returns (results, report_lines), where results is a list with a dict for each row with:
         - percent_coverage: Percentage of the survey area covered by polygons.
         - percent_coverage_hc: Percentage of the survey area covered by polygons with certainty >= certainty_cutoff.
         - poly_avg_size: Average size of the polygons covering the survey area.
@@ -44,84 +112,102 @@ def process_survey_row(row, polygons, certainty_cutoff, idx):
         - percent_coverage_hc_industrial: ... 'industrial'.
         - percent_coverage_hc_lawn: ... 'lawn'.
         - percent_coverage_hc_covered: ... 'covered'.
+    and report_lines is a list with the lines for polygons that do not overlap their survey area for each row.
     """
-    # Initialize result dict with default values and consistent names
-    result = {
-        "percent_coverage": 0.0,
-        "percent_coverage_hc": 0.0,
-        "poly_avg_size": None,
-        "poly_avg_size_hc": None,
-        "poly_min_size": None,
-        "poly_min_size_hc": None,
-        "percent_coverage_hc_plantation": 0.0,
-        "percent_coverage_hc_industrial": 0.0,
-        "percent_coverage_hc_lawn": 0.0,
-        "percent_coverage_hc_covered": 0.0,
+    # Clean the geometries to ensure they are valid
+    geometries = shapely.make_valid(np.asarray(polygons.geometry.values))
+
+    # Project each polygon to the UTM zone of the first survey row it matches (unmatched polygons are not needed)
+    pair_rows = np.repeat(np.arange(len(matches)), [len(positions) for positions in matches])
+    pair_polygons = np.array([position for positions in matches for position in positions], dtype=np.int64)
+    polygon_epsg_codes = np.zeros(len(polygons), dtype=np.int64)
+    polygon_epsg_codes[pair_polygons[::-1]] = survey_epsg_codes[pair_rows[::-1]]
+    projected_polygons = project_to_utm(geometries, polygon_epsg_codes)
+    projected_surveys = project_to_utm(survey_geometries, survey_epsg_codes)
+
+    # Calculate the size of the polygons in square meters
+    areas = shapely.area(projected_polygons)
+
+    high_certainty = (polygons["certainty"] >= certainty_cutoff).to_numpy()
+    special_masks = {
+        special: polygons["special_category"].astype(str).str.contains(special, case=False, na=False).to_numpy() if "special_category" in polygons.columns else np.zeros(len(polygons), dtype=bool)
+        for special in SPECIAL_CATEGORIES
     }
 
-    # Find polygons that match by internal_id (or site_id if the labeler accidentally used that), year, month, and day.
-    condition = (
-        ((polygons["internal_id"] == row["internal_id"]) | 
-         (polygons["internal_id"] == int(row["site_id"][3:]))) &
-        (polygons["year"] == row["year"]) &
-        (polygons["month"] == row["month"]) &
-        (polygons["day"] == row["day"])
-    )
-    matching_polys = polygons[condition].copy()
-
-    # Get irrigation value and perform checks.
-    irrigation = int(row["irrigation"])
-
-    # Consistency checks between irrigation and polygons
-    report_lines = check_irrigation_polygon_consistency(row, matching_polys, irrigation, idx)
-
-    # Add the site_id to matched polygons
-    if not matching_polys.empty:
-        polygons.loc[condition, "site_id"] = row["site_id"]
-
-    # Compute percent coverage and related stats if there are matching polygons
-    survey_area = row["geometry"].area
-    if not matching_polys.empty:
-        # Clean the geometries to ensure they are valid
-        matching_polys.geometry = [make_valid(geom) for geom in matching_polys.geometry]
-
-        # Check that all polygons are at least partially overlapping the survey area
-        for poly_idx, poly in matching_polys.iterrows():
-            if not row["geometry"].intersects(poly["geometry"]):
-                report_lines.append(f"Polygon {poly_idx} (internal_id {poly['internal_id']}, {poly['day']}/{poly['month']}/{poly['year']}) does not overlap the survey area.")
-        
-        # Calculate the average and min size of the polygons in square meters (use local CRS)
-        result["poly_avg_size"] = matching_polys.to_crs("EPSG:32735").geometry.area.mean()
-        result["poly_min_size"] = matching_polys.to_crs("EPSG:32735").geometry.area.min()
-        
-        # Calculate the overlap
-        union_all = unary_union(matching_polys.geometry)
-        intersection_all = row["geometry"].intersection(union_all)
-        result["percent_coverage"] = (intersection_all.area / survey_area) * 100 if survey_area > 0 else 0.0
+    # Check that all polygons are at least partially overlapping the survey area
+    overlaps = shapely.intersects(survey_geometries[pair_rows], geometries[pair_polygons])
+    report_lines = [[] for _ in matches]
+    for row_number, position in zip(pair_rows[~overlaps], pair_polygons[~overlaps]):
+        poly = polygons.iloc[position]
+        report_lines[row_number].append(f"Polygon {polygons.index[position]} (internal_id {poly['internal_id']}, {poly['day']}/{poly['month']}/{poly['year']}) does not overlap the survey area.")
 
-        # For high-certainty coverage, filter for certainty >= certainty_cutoff.
-        high_polys = matching_polys[matching_polys["certainty"] >= certainty_cutoff]
+    # Union of each set of polygons, computed once
+    unions = {}
+    def union(positions):
+        key = tuple(positions)
+        if key not in unions:
+            unions[key] = shapely.union_all(projected_polygons[list(key)])
+        return unions[key]
+
+    # The polygons to intersect with the survey area for each row and output column
+    results = []
+    coverage_rows = []
+    coverage_columns = []
+    coverage_unions = []
+    for row_number, positions in enumerate(matches):
+        # Initialize result dict with default values and consistent names
+        result = {
+            "percent_coverage": 0.0,
+            "percent_coverage_hc": 0.0,
+            "poly_avg_size": None,
+            "poly_avg_size_hc": None,
+            "poly_min_size": None,
+            "poly_min_size_hc": None,
+            "percent_coverage_hc_plantation": 0.0,
+            "percent_coverage_hc_industrial": 0.0,
+            "percent_coverage_hc_lawn": 0.0,
+            "percent_coverage_hc_covered": 0.0,
+        }
+        results.append(result)
+        if not positions:
+            continue
+
+        positions = np.array(positions)
+        result["poly_avg_size"] = areas[positions].mean()
+        result["poly_min_size"] = areas[positions].min()
+        coverage_rows.append(row_number)
+        coverage_columns.append("percent_coverage")
+        coverage_unions.append(union(positions))
 
-        # Calculate the average and min size of the high-certainty polygons in square meters (use local CRS)
-        if not high_polys.empty:
-            result["poly_avg_size_hc"] = high_polys.to_crs("EPSG:32735").geometry.area.mean()
-            result["poly_min_size_hc"] = high_polys.to_crs("EPSG:32735").geometry.area.min()
-            # Calculate the coverage/overlap for high-certainty polygons
-            union_high = unary_union(high_polys.geometry.tolist())
-            intersection_high = row["geometry"].intersection(union_high)
-            result["percent_coverage_hc"] = (intersection_high.area / survey_area) * 100 if survey_area > 0 else 0.0
+        # For high-certainty coverage, filter for certainty >= certainty_cutoff.
+        high_positions = positions[high_certainty[positions]]
+        if len(high_positions):
+            result["poly_avg_size_hc"] = areas[high_positions].mean()
+            result["poly_min_size_hc"] = areas[high_positions].min()
+            coverage_rows.append(row_number)
+            coverage_columns.append("percent_coverage_hc")
+            coverage_unions.append(union(high_positions))
 
             # For each special category, calculate percent coverage
-            for special in ["plantation", "industrial", "lawn", "covered"]:
-                special_polys = high_polys[high_polys["special_category"].astype(str).str.contains(special, case=False, na=False)]
-                if not special_polys.empty:
-                    union_special = unary_union(special_polys.geometry.tolist())
-                    intersection_special = row["geometry"].intersection(union_special)
-                    result[f"percent_coverage_hc_{special}"] = (intersection_special.area / survey_area) * 100 if survey_area > 0 else 0.0
+            for special in SPECIAL_CATEGORIES:
+                special_positions = high_positions[special_masks[special][high_positions]]
+                if len(special_positions):
+                    coverage_rows.append(row_number)
+                    coverage_columns.append(f"percent_coverage_hc_{special}")
+                    coverage_unions.append(union(special_positions))
+
+    # Calculate the overlaps of all rows at once (in square meters)
+    if coverage_rows:
+        coverage_rows = np.array(coverage_rows)
+        survey_areas = shapely.area(projected_surveys[coverage_rows])
+        overlap_areas = shapely.area(shapely.intersection(projected_surveys[coverage_rows], np.array(coverage_unions, dtype=object)))
+        for row_number, column, survey_area, overlap_area in zip(coverage_rows, coverage_columns, survey_areas, overlap_areas):
+            results[row_number][column] = (overlap_area / survey_area) * 100 if survey_area > 0 else 0.0
 
-    return result, report_lines
+    return results, report_lines
 
-def merge_and_check(survey_path: str, polygons_path: Optional[str] = None, certainty_cutoff: Optional[int] = 3):
+def merge_and_check(survey_path: str, polygons_path: Optional[str] = None, certainty_cutoff: Optional[int] = 3,
+                    box_cache_path: Optional[str] = None):
     """
     Loads in and merges survey data with polygon data, performs consistency checks, and calculates percent coverage.
     This function processes survey data and polygon data to ensure consistency between the two datasets.
@@ -139,6 +225,8 @@ def merge_and_check(survey_path: str, polygons_path: Optional[str] = None, certa
             - geometry: Polygon geometry.
             - certainty: Certainty level of the polygon (1-5).
         certainty_cutoff (int): How high does an irrigation certainty need to be to be considered "high certainty"?
+        box_cache_path (str, optional): Parquet file to load the site box cache from and save it back to. Without it,
+            boxes are only cached in memory for the rest of the process.
     Returns:
         gpd.GeoDataFrame: A GeoDataFrame containing the survey data with additional columns added using process_survey_row
     Raises:
@@ -158,9 +246,9 @@ def merge_and_check(survey_path: str, polygons_path: Optional[str] = None, certa
     # Load the survey and polygon data.
     survey = pd.read_csv(survey_path)
     if polygons_path:
-        polygons = gpd.read_file(polygons_path)
+        polygons = read_polygons(polygons_path)
     else: 
-        polygons = gpd.read_file(survey_path.replace(".csv", ".geojson"))
+        polygons = read_polygons(find_polygons(survey_path))  # GeoJSON, GeoParquet or FlatGeobuf
 
     # Initialize the report as a list of strings.
     report = []
@@ -168,26 +256,42 @@ def merge_and_check(survey_path: str, polygons_path: Optional[str] = None, certa
     # For area calculations we need a geometry for each survey row.
     # The survey CSV includes columns: internal_id, year, month, day, irrigation, x (lon), and y (lat).
 
-    survey["geometry"] = survey.apply(survey_polygon, axis=1)
+    # Each site has a row per image date, so the box of each site is computed once and cached across files and stages
+    box_cache = get_site_box_cache(box_cache_path)
+    survey["geometry"] = box_cache.boxes(survey["site_id"], survey["y"], survey["x"])
+    if box_cache_path:
+        box_cache.save()
     survey_gdf = gpd.GeoDataFrame(survey, geometry="geometry", crs="EPSG:4326")
 
-    # We will add a column for the overall location id to the geojson too
-    # This will help us ensure that all polygons get matched to a location
-    polygons["site_id"] = None 
+    # Index the polygons by internal_id and date, and keep track of which polygons get matched to a location
+    polygon_index = build_polygon_index(polygons)
+    matched = set()
 
-    # Process each survey row, collect results and reports
-    results = []
+    # Match polygons to each survey row and check consistency between irrigation and polygons
+    # (the checks only need the certainty, so the geometries are not copied for every row)
+    matches = []
+    consistency_reports = []
+    certainties = polygons[["certainty"]]
     for idx, row in survey_gdf.iterrows():
-        result, row_report = process_survey_row(row, polygons, certainty_cutoff, idx)
-        results.append(result)
-        report.extend(row_report)
+        matched_positions = match_polygons(row, polygon_index)
+        irrigation = int(row["irrigation"])
+        consistency_reports.append(check_irrigation_polygon_consistency(row, certainties.iloc[matched_positions], irrigation, idx))
+        matches.append(matched_positions)
+        matched.update(matched_positions)
+
+    # Compute percent coverage and related stats for all rows
+    survey_epsg_codes = utm_epsg_codes(survey_gdf["x"], survey_gdf["y"])
+    results, overlap_reports = coverage_statistics(np.asarray(survey_gdf.geometry.values), polygons, matches, certainty_cutoff, survey_epsg_codes)
+    for consistency_report, overlap_report in zip(consistency_reports, overlap_reports):
+        report.extend(consistency_report)
+        report.extend(overlap_report)
 
     # After processing, add the results as new columns
     results_df = pd.DataFrame(results)
     survey_gdf = pd.concat([survey_gdf.reset_index(drop=True), results_df.reset_index(drop=True)], axis=1)
 
     # After processing all survey rows, check for any polygons that were not matched.
-    unmatched_polys = polygons[~polygons["site_id"].notnull()]
+    unmatched_polys = polygons.iloc[[position for position in range(len(polygons)) if position not in matched]]
     for poly_idx, poly in unmatched_polys.iterrows():
         report.append(f"Polygon {poly_idx} (internal_id {poly['internal_id']}, {poly['day']}/{poly['month']}/{poly['year']}) has no matching survey row.")
 
@@ -234,12 +338,13 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Merge survey data with polygon data and perform consistency checks.")
     parser.add_argument("survey_path", type=str, help="Path to the survey CSV file.")
-    parser.add_argument("--polygons_path", type=str, help="Path to the polygons GeoJSON file (optional).")
+    parser.add_argument("--polygons_path", type=str, help="Path to the polygons GeoJSON, GeoParquet or FlatGeobuf file (optional).")
+    parser.add_argument("--box_cache", type=str, help="Parquet file to cache the survey boxes of each site in between runs (optional).")
     args = parser.parse_args()
     
     survey_path = args.survey_path
     polygons_path = args.polygons_path if args.polygons_path else None
     
-    survey_results = merge_and_check(survey_path, polygons_path)
+    survey_results = merge_and_check(survey_path, polygons_path, box_cache_path=args.box_cache)
     
     print(f"Merged results have {len(survey_results)} rows.")
@@ -1,10 +1,19 @@
 import xml.etree.ElementTree as ET
-import json
-import geopandas as gpd
 import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
 
 # Define the KML namespace
 ns = {'kml': 'http://www.opengis.net/kml/2.2'}
+PLACEMARK = f"{{{ns['kml']}}}Placemark"
+
+# Supported output formats for processed polygons and their file extensions
+POLYGON_FORMATS = {"geojson": ".geojson", "parquet": ".parquet", "fgb": ".fgb"}
+FEATURE_ORDER = "feature_order"
 
 def parse_name(name_text):
     """
@@ -94,9 +103,10 @@ def parse_description(desc_text): # Note you will need to update to handle speci
         "special_category": special_category_str
     }
 
-def convert_geometry(placemark):
+def ring_coordinates(placemark):
     """
-    Converts a KML geometry element (Point, LineString, or Polygon) to a GeoJSON geometry dict.
+    Returns the coordinate text of the outer ring of a KML Polygon placemark, or None for other geometries
+    (Point, LineString) and placemarks without a geometry.
     """
     # Check for Point
     point = placemark.find("kml:Point", ns)
@@ -116,30 +126,161 @@ def convert_geometry(placemark):
         outer = polygon.find("kml:outerBoundaryIs/kml:LinearRing", ns)
         if outer is None:
             raise ValueError("Polygon without an outerBoundaryIs/LinearRing element")
-        coords_text = outer.find("kml:coordinates", ns).text.strip()
-        coords = []
-        for coord in coords_text.split():
-            parts = coord.split(',')
-            lon, lat = float(parts[0]), float(parts[1])
-            coords.append([lon, lat])
-        # GeoJSON expects polygons as a list of linear rings.
-        return {"type": "Polygon", "coordinates": [coords]}
+        return (outer.find("kml:coordinates", ns).text or "").strip()
     
     # If no supported geometry is found, return None.
     return None
 
-def kml_to_geojson(kml_file):
+def decode_rings(coordinate_texts):
+    """
+    Decode the coordinate strings of many rings ("lon,lat[,alt] lon,lat[,alt] ...") at once into shapely Polygons.
+
+    All numbers are converted to floats in one call, and the polygons are built with shapely's vectorized
+    constructors instead of one vertex at a time. Rings with fewer than 3 distinct vertices (including empty
+    ones) become empty polygons, so one bad placemark does not fail the whole file.
+    """
+    if not coordinate_texts:
+        return np.empty(0, dtype=object)
+
+    values = []
+    counts = np.empty(len(coordinate_texts), dtype=np.int64)
+    dims = np.empty(len(coordinate_texts), dtype=np.int64)
+    for i, text in enumerate(coordinate_texts):
+        ring_values = text.replace(",", " ").split()
+        counts[i] = len(ring_values)
+        dims[i] = text.split(maxsplit=1)[0].count(",") + 1 if ring_values else 2  # 2 for lon,lat and 3 for lon,lat,alt
+        values.extend(ring_values)
+    values = np.array(values, dtype=np.float64)
+
+    # Keep lon and lat of each vertex
+    vertices = counts // dims
+    starts = np.repeat(np.cumsum(counts) - counts, vertices)
+    offsets = (np.arange(vertices.sum()) - np.repeat(np.cumsum(vertices) - vertices, vertices)) * np.repeat(dims, vertices)
+    lon = values[starts + offsets]
+    lat = values[starts + offsets + 1]
+
+    # A ring needs at least 3 distinct vertices (not counting a closing vertex that repeats the first one)
+    first = np.cumsum(vertices) - vertices
+    closed = np.zeros(len(vertices), dtype=bool)
+    several = vertices > 1
+    last = first[several] + vertices[several] - 1
+    closed[several] = (lon[first[several]] == lon[last]) & (lat[first[several]] == lat[last])
+    valid = vertices - closed >= 3
+
+    # Only the valid rings go through the bulk constructors, numbered consecutively as shapely requires
+    polygons = np.array([shapely.Polygon() for _ in range(len(coordinate_texts))], dtype=object)
+    if valid.any():
+        keep = np.repeat(valid, vertices)
+        ring_numbers = np.repeat(np.cumsum(valid) - 1, vertices)[keep]
+        rings = shapely.linearrings(np.column_stack([lon[keep], lat[keep]]), indices=ring_numbers)
+        polygons[valid] = shapely.polygons(rings)
+    return polygons
+
+def read_placemarks(kml_file):
+    """
+    Stream through a KML file and return the properties and outer ring coordinates of every polygon placemark.
+
+    Each Placemark is parsed as soon as it has been read and then freed, so memory use does not grow with the size
+    of the file.
+    """
+    records = []
+    coordinate_texts = []
+    parents = []
+    for event, elem in ET.iterparse(kml_file, events=("start", "end")):
+        if event == "start":
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag != PLACEMARK:
+            continue
+
+        # Extract and parse <name>
+        name_elem = elem.find("kml:name", ns)
+        if name_elem is not None and name_elem.text:
+            try:
+                props = parse_name(name_elem.text.strip())
+            except ValueError as e:
+                print(e)
+                props = {}
+
+            # Extract and parse <description>
+            desc_elem = elem.find("kml:description", ns)
+            if desc_elem is not None and desc_elem.text:
+                desc_props = parse_description(desc_elem.text)
+            else:
+                desc_props = {"certainty": 5, "uncertainty_explanation": ""}
+
+            # Merge properties and get the geometry
+            coordinates = ring_coordinates(elem)
+            if coordinates is None:
+                print(f"No supported geometry found for placemark {name_elem.text}")
+            else:
+                records.append({"name": name_elem.text, **props, **desc_props})
+                coordinate_texts.append(coordinates)
+
+        # Free the placemark
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+    return records, coordinate_texts
+
+def polygons_path(path, output_format):
+    """Return the path of the processed polygon file with the given format (geojson, parquet or fgb)."""
+    return os.path.splitext(path)[0] + POLYGON_FORMATS[output_format]
+
+def write_polygons(gdf, path, output_format="geojson"):
+    """
+    Write polygons as GeoJSON, GeoParquet or FlatGeobuf (which includes a spatial index).
+    """
+    if output_format == "parquet":
+        gdf.to_parquet(path, index=False)
+    elif output_format == "fgb":
+        # The spatial index reorders the features, so the original order is kept in a column. Empty polygons are
+        # stored as NULL geometries, which a spatial index cannot hold, so files with any are written without one.
+        spatial_index = "NO" if (gdf.geometry.isna() | gdf.geometry.is_empty).any() else "YES"
+        gdf.assign(**{FEATURE_ORDER: np.arange(len(gdf))}).to_file(path, driver="FlatGeobuf", SPATIAL_INDEX=spatial_index)
+    elif output_format == "geojson":
+        gdf.to_file(path, driver="GeoJSON")
+    else:
+        raise ValueError(f"Unsupported polygon format: {output_format}")
+
+def find_polygons(path):
+    """
+    Return the processed polygon file that matches a processed survey or polygon file (any extension), in any of
+    the supported formats. If there is more than one, the most recently written one is used.
+    """
+    candidates = [polygons_path(path, output_format) for output_format in POLYGON_FORMATS]
+    candidates = [candidate for candidate in candidates if os.path.exists(candidate)]
+    if not candidates:
+        raise FileNotFoundError(f"No processed polygons found for {path} (looked for {', '.join(POLYGON_FORMATS.values())}).")
+    return max(candidates, key=os.path.getmtime)
+
+def read_polygons(path):
+    """Read processed polygons written by write_polygons, using the native reader for the format."""
+    if path.endswith(".parquet"):
+        return gpd.read_parquet(path)
+    gdf = gpd.read_file(path)
+    if FEATURE_ORDER in gdf.columns:
+        gdf = gdf.sort_values(FEATURE_ORDER).drop(columns=FEATURE_ORDER).reset_index(drop=True)
+        # FlatGeobuf stores empty polygons as NULL geometries
+        gdf.loc[gdf.geometry.isna(), "geometry"] = shapely.Polygon()
+    return gdf
+
+def kml_to_geojson(kml_file, output_format="geojson"):
     """
     Converts a KML file that contains a folder of polygons exported from Google 
     Earth Pro to a GeoJSON file and returns a GeoPandas GeoDataFrame.
-    This function parses a KML file, extracts placemark data, converts the geometries 
-    to GeoJSON format, and writes the resulting GeoJSON to a file. It also returns 
-    a GeoPandas GeoDataFrame created from the GeoJSON features.
+    This function streams through a KML file, extracts placemark data, converts the geometries 
+    to shapely polygons in bulk, and writes the resulting polygons to a file. It also returns 
+    them as a GeoPandas GeoDataFrame.
     Args:
         kml_file (str): The file path to the input KML file.
+        output_format (str): "geojson" (default), or "parquet" (GeoParquet) or "fgb" (FlatGeobuf), which are
+            smaller and much faster to read.
     Returns:
         geopandas.GeoDataFrame: A GeoDataFrame containing the features from the 
-        converted GeoJSON file.
+        converted KML file.
     Notes:
         - The function expects the KML file to have placemarks with <name>, 
           <description>, and geometry elements.
@@ -147,8 +288,9 @@ def kml_to_geojson(kml_file):
         - The <description> element is parsed to extract additional properties using 
           the `parse_description` function.
         - If a placemark lacks a supported geometry, it is skipped.
-        - The resulting GeoJSON file is saved in the same directory as the input KML file, 
-          with the same name but a `.geojson` extension.
+        - Polygons with empty coordinates or fewer than 3 vertices are written as empty polygons.
+        - The resulting file is saved in the processed folder next to the raw folder of the input KML file, 
+          with the same name but a `.geojson` (or `.parquet` or `.fgb`) extension.
     Raises:
         ValueError: If the <name> element cannot be parsed by `parse_name`.
     Example:
@@ -156,67 +298,49 @@ def kml_to_geojson(kml_file):
         GeoJSON written to example.geojson
         >>> print(gdf.head())
     """
-    
-
-    tree = ET.parse(kml_file)
-    root = tree.getroot()
-
-    features = []
-
-    # Iterate over each Placemark in the KML
-    for placemark in root.findall(".//kml:Placemark", ns):
-        # Extract and parse <name>
-        name_elem = placemark.find("kml:name", ns)
-        if name_elem is None or not name_elem.text:
-            continue  # Skip placemarks without a name
-        try:
-            props = parse_name(name_elem.text.strip())
-        except ValueError as e:
-            print(e)
-            props = {}
-
-        # Extract and parse <description>
-        desc_elem = placemark.find("kml:description", ns)
-        if desc_elem is not None and desc_elem.text:
-            desc_props = parse_description(desc_elem.text)
-        else:
-            desc_props = {"certainty": 5, "uncertainty_explanation": ""}
-
-        # Merge properties
-        properties = {"name": name_elem.text, **props, **desc_props}
+    records, coordinate_texts = read_placemarks(kml_file)
+    geometries = decode_rings(coordinate_texts)
+    for record, text, geometry in zip(records, coordinate_texts, geometries):
+        if text and geometry.is_empty:
+            print(f"Warning: Polygon with fewer than 3 vertices in placemark {record['name']}. Writing it as an empty polygon")
+    gdf = gpd.GeoDataFrame(pd.DataFrame.from_records(records), geometry=geometries, crs="EPSG:4326")
+    gdf = gdf[["geometry"] + [column for column in gdf.columns if column != "geometry"]]
 
-        # Convert the geometry
-        geometry = convert_geometry(placemark)
-        if geometry is None:
-            print(f"No supported geometry found for placemark {name_elem.text}")
-            continue
-
-        # Build a GeoJSON feature
-        feature = {
-            "type": "Feature",
-            "properties": properties,
-            "geometry": geometry
-        }
-        features.append(feature)
-
-    # Build the FeatureCollection
-    feature_collection = {
-        "type": "FeatureCollection",
-        "features": features
-    }
-
-    # Write the GeoJSON to a file
+    # Write the polygons to a file
     processed_folder = os.path.dirname(kml_file).replace("/raw", "/processed")
     os.makedirs(processed_folder, exist_ok=True)
-    geojson_file = os.path.join(processed_folder, os.path.basename(kml_file).replace(".kml", ".geojson"))
-
-    with open(geojson_file, "w") as f:
-        json.dump(feature_collection, f, indent=2)
-    print(f"GeoJSON written to {geojson_file}")
+    output_file = polygons_path(os.path.join(processed_folder, os.path.basename(kml_file)), output_format)
+    write_polygons(gdf, output_file, output_format)
+    print(f"Polygons written to {output_file}")
 
-    gdf = gpd.GeoDataFrame.from_features(feature_collection["features"])
     return gdf
 
+def convert_polygons(path, output_format="parquet"):
+    """
+    Convert an existing processed GeoJSON file (or every one in a folder) to another polygon format.
+    """
+    paths = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(".geojson")] if os.path.isdir(path) else [path]
+    for geojson_file in paths:
+        output_file = polygons_path(geojson_file, output_format)
+        write_polygons(read_polygons(geojson_file), output_file, output_format)
+        print(f"Converted {geojson_file} to {output_file}")
+
+def benchmark_formats(geojson_file, repeats=3):
+    """
+    Compare the size and read time of a processed GeoJSON file with its GeoParquet and FlatGeobuf versions.
+    """
+    gdf = read_polygons(geojson_file)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for output_format in POLYGON_FORMATS:
+            path = polygons_path(os.path.join(tmp_dir, os.path.basename(geojson_file)), output_format)
+            write_polygons(gdf, path, output_format)
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                read_polygons(path)
+                times.append(time.perf_counter() - start)
+            print(f"{output_format:>8}: {os.path.getsize(path) / 1e6:8.2f} MB, read in {min(times) * 1000:8.1f} ms ({len(gdf)} polygons, best of {repeats})")
+
 # Example usage:
 if __name__ == "__main__":
 
@@ -229,8 +353,15 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Convert KML to GeoJSON.")
-    parser.add_argument("kml_file", type=str, help="Path to the KML file to convert.")
+    parser.add_argument("kml_file", type=str, help="Path to the KML file to convert (or, with --convert/--benchmark, a processed GeoJSON file or folder).")
+    parser.add_argument("--format", type=str, default="geojson", choices=list(POLYGON_FORMATS), help="Output format: geojson, parquet (GeoParquet) or fgb (FlatGeobuf).")
+    parser.add_argument("--convert", action="store_true", help="Convert existing processed GeoJSON file(s) to --format instead of converting a KML.")
+    parser.add_argument("--benchmark", action="store_true", help="Compare the size and read time of a processed GeoJSON file in each format.")
     args = parser.parse_args()
     
-    kml_file = args.kml_file
-    gdf = kml_to_geojson(kml_file)
+    if args.benchmark:
+        benchmark_formats(args.kml_file)
+    elif args.convert:
+        convert_polygons(args.kml_file, args.format)
+    else:
+        gdf = kml_to_geojson(args.kml_file, args.format)
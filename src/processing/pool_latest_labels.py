@@ -10,9 +10,8 @@ if project_root not in sys.path:
 
 # Now import the module
 from src.utils.utils import *
-from src.utils.geometries import bounding_box
+from src.utils.geometries import get_site_box_cache, SITE_BOX_CACHE
 import geopandas as gpd
-from shapely.geometry import box
 
 group_name = "random_sample"
 latest_irrigation_data = generate_latest_irrigation_data(group_name)
@@ -25,10 +24,12 @@ csv_path = f"labels/labeled_surveys/{group_name}/latest_irrigation_table.csv"
 description = "The latest labeled irrigation data"
 save_data(latest_irrigation_data, csv_path, description=description, file_format="csv")
 
-# Generate bounding boxes as Shapely geometries for each row
-latest_irrigation_data['geometry'] = latest_irrigation_data.apply(
-    lambda row: box(*bounding_box(row['y'], row['x'], half_side_km=0.5)), axis=1
+# Generate bounding boxes as Shapely geometries for each row, reusing the boxes of sites that were already merged
+box_cache = get_site_box_cache(os.path.join(get_data_root(), SITE_BOX_CACHE))
+latest_irrigation_data['geometry'] = box_cache.boxes(
+    latest_irrigation_data['site_id'], latest_irrigation_data['y'], latest_irrigation_data['x'], half_side_km=0.5
 )
+box_cache.save()
 
 # Convert the DataFrame to a GeoDataFrame
 latest_irrigation_data_gdf = gpd.GeoDataFrame(latest_irrigation_data, geometry='geometry', crs="EPSG:4326")
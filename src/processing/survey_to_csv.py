@@ -2,22 +2,93 @@
 # It expects the file name to start with the operator initials and end with the range of survey locations, separated by underscores. There can be anything else in between. @
 
 import os
+import time
+import zipfile
 import xml.etree.ElementTree as ET
 import pandas as pd
-import shutil
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
-def parse_xml(file_path, original_location_file=None):
+# Output columns, in order
+COLUMNS = ["site_id", "internal_id", "plot_file", "operator", "operator_initials", "x", "y", "water_source",
+           "image_number", "year", "month", "day", "irrigation"]
+
+# Site-level fields and where they are in the XML
+SITE_FIELDS = {
+    "site_id": "id/value",
+    "x": "location/x",
+    "y": "location/y",
+    "operator": "operator/value",
+    "plot_file": "plot_file/value",
+    "water_source": "natural_dicoloration/value",
+}
+
+# Day-level fields (year1/code, month1/code, day1/value, irrigation1/code, ...) for up to 10 images
+DAY_FIELDS = {"year": "code", "month": "code", "day": "value", "irrigation": "code"}
+N_IMAGES = 10
+
+def read_fields(xml_file):
+    """
+    Stream through a survey XML and return the text of every element two levels below the root, keyed by its path
+    (e.g. "id/value" or "year1/code"). Only the first occurrence of each path is kept, as with root.find().
+
+    Args:
+        xml_file (str or file): Path to, or open file of, the XML.
+    """
+    fields = {}
+    path = []
+    for event, elem in ET.iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            path.append(elem.tag)
+            continue
+
+        if len(path) == 3:
+            fields.setdefault(f"{path[1]}/{path[2]}", elem.text)
+        path.pop()
+        if len(path) == 1:
+            elem.clear()  # Done with this field of the root
+    return fields
+
+@lru_cache(maxsize=64)
+def _load_id_crosswalk(original_location_file, modified_time):
+    # the original location file lists the ids in order. 
+    # We can use the index of the ids (index + 1) to get the internal id
+    ids = pd.read_csv(original_location_file, usecols=["id"])["id"].tolist()
+    crosswalk = {}
+    for index, site_id in enumerate(ids):
+        crosswalk.setdefault(site_id, index + 1)  # The first occurrence wins, as before
+    return crosswalk
+
+def load_id_crosswalk(original_location_file):
+    """
+    Return a dict from site id to internal id (its position in the original location file, starting at 1).
+
+    The file is read once and kept in an LRU cache, so every XML of a zip (and every zip of the same sample in a
+    batch run) shares the same lookup table. A file that changed on disk is read again.
+    """
+    return _load_id_crosswalk(original_location_file, os.path.getmtime(original_location_file))
+
+def empty_columns():
+    """Return a dict with an empty list for each output column."""
+    return {column: [] for column in COLUMNS}
+
+def parse_xml(xml_file, operator_initials, internal_id, original_location_file=None):
     """
     Parses an XML file to extract site-level and day-level irrigation data.
     Args:
-        file_path (str): The file path to the XML file to be parsed.
+        xml_file (str or file): The XML file to be parsed (a path, or an open file such as a member of the export zip).
+        operator_initials (str): The initials of the operator, derived from the name of the export.
+        internal_id (int): The internal ID derived from the filename (without extension). Replaced by crosswalking
+            with the original location file if one is given.
+        original_location_file (str, optional): The sample the survey was generated from.
     Returns:
-        list[dict]: A list of dictionaries, where each dictionary contains the following keys:
+        dict[str, list]: The raw (unvalidated) records of the site as columns, one per day record with a year,
+        with the following keys:
             - site_id (str or None): The site ID extracted from the XML.
             - internal_id (int): The internal ID derived from the filename (without extension) or by crosswalking with id file.
             - plot_file (str or None): The plot file value from the XML.
             - operator (str or None): The operator value from the XML.
-            - operator_initials (str): The initials of the operator, derived from the file path.
+            - operator_initials (str): The initials of the operator.
             - x (str or None): The x-coordinate of the location from the XML.
             - y (str or None): The y-coordinate of the location from the XML.
             - water_source (str or None): The water source value from the XML.
@@ -30,114 +101,133 @@ def parse_xml(file_path, original_location_file=None):
         - The function assumes that the XML file contains up to 10 day records, each with fields
           such as year, month, day, and irrigation.
         - If a field is missing or not found in the XML, its value will be set to None.
-        - The operator initials are extracted from the file path by splitting the directory name
-          preceding the file name.
     """
-
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    
-    # Extract site-level information
-    operator_initials = str.split(str.split(file_path, "/")[-3], "_")[0]
-    site_id = root.find("id/value").text if root.find("id/value") is not None else None
-    x = root.find("location/x").text if root.find("location/x") is not None else None
-    y = root.find("location/y").text if root.find("location/y") is not None else None
-    operator = root.find("operator/value").text if root.find("operator/value") is not None else None
-    plot_file = root.find("plot_file/value").text if root.find("plot_file/value") is not None else None
-    water_source = root.find("natural_dicoloration/value").text if root.find("natural_dicoloration/value") is not None else None
+    fields = read_fields(xml_file)
+    site = {column: fields.get(path) for column, path in SITE_FIELDS.items()}
 
     if original_location_file:
-        # the original location file lists the ids in order. 
-        # We can use the index of the ids (index + 1) to get the internal id
-        
-        ids_cross = pd.read_csv(original_location_file)
-        ids_cross = ids_cross[ids_cross["id"] == site_id]
-        if ids_cross.empty:
+        internal_id = load_id_crosswalk(original_location_file).get(site["site_id"])
+        if internal_id is None:
             # print(f"Warning: {site_id} not found in original location file. Removing this line from the output.")
-            return []
-        else:
-            internal_id = ids_cross.index[0] + 1
-    else:
-        internal_id = int(os.path.splitext(os.path.basename(file_path))[0]) # The filename without extension
-
-    records = []
-    # Iterate over potential day records (assuming up to 10)
-    for i in range(1, 11):
-        year_elem = root.find(f"year{i}")
-        month_elem = root.find(f"month{i}")
-        day_elem = root.find(f"day{i}")
-        irrigation_elem = root.find(f"irrigation{i}")
-
-        if year_elem is not None and year_elem.find("code") is not None:
-            year = year_elem.find("code").text
-            month = month_elem.find("code").text if (month_elem is not None and month_elem.find("code") is not None) else None
-            day = day_elem.find("value").text if (day_elem is not None and day_elem.find("value") is not None) else None
-            irrigation = irrigation_elem.find("code").text if (irrigation_elem is not None and irrigation_elem.find("code") is not None) else None
-
-            # Turn the year month and day into a date object to check its validity
-            try:
-                date = pd.to_datetime(f"{year}-{month}-{day}", format="%Y-%m-%d")
-            except ValueError:
-                date = None
-            
-            # Only create a row if the date is valid and there is an irrigation code
-            if date and irrigation:
-
-                records.append({
-                    "site_id": site_id,
-                    "internal_id": internal_id, 
-                    "plot_file": plot_file,
-                    "operator": operator,
-                    "operator_initials": operator_initials,
-                    "x": x,
-                    "y": y,
-                    "water_source": water_source,
-                    "image_number": i,
-                    "year": year,
-                    "month": month,
-                    "day": day,
-                    "irrigation": irrigation,
-                })
-    return records
-
-def process_xml_zip(xml_zip, original_location_file=None):
+            return empty_columns()
+
+    # Collect the raw codes of every day record with a year (up to 10); they are validated by build_records
+    columns = empty_columns()
+    for i in range(1, N_IMAGES + 1):
+        if fields.get(f"year{i}/{DAY_FIELDS['year']}") is None:
+            continue
+        for name, child in DAY_FIELDS.items():
+            columns[name].append(fields.get(f"{name}{i}/{child}"))
+        columns["image_number"].append(i)
+
+    n = len(columns["image_number"])
+    for column, value in site.items():
+        columns[column] = [value] * n
+    columns["internal_id"] = [internal_id] * n
+    columns["operator_initials"] = [operator_initials] * n
+    return columns
+
+def build_records(columns):
+    """
+    Validate the raw columns of a batch of parsed XMLs and build the typed survey records.
+
+    Only day records with a valid date and an irrigation code are kept. Dates are checked for the whole batch at
+    once, and columns are cast to integer, float and categorical dtypes.
+
+    Args:
+        columns (dict[str, list]): Raw columns from parse_xml.
+    Returns:
+        pd.DataFrame: The survey records, with the columns in COLUMNS.
+    """
+    df = pd.DataFrame(columns, columns=COLUMNS)
+
+    # Turn the year month and day into dates to check their validity
+    dates = pd.to_datetime(
+        df["year"].astype(str) + "-" + df["month"].astype(str) + "-" + df["day"].astype(str),
+        format="%Y-%m-%d", errors="coerce"
+    )
+
+    # Only keep a row if the date is valid and there is an irrigation code
+    valid = dates.notna() & df["irrigation"].notna() & (df["irrigation"] != "")
+    df = df[valid.to_numpy()].reset_index(drop=True)
+    dates = dates[valid.to_numpy()].reset_index(drop=True)
+
+    df["internal_id"] = df["internal_id"].astype("int64")
+    df["image_number"] = df["image_number"].astype("int8")
+    df["year"] = dates.dt.year.astype("int16")
+    df["month"] = dates.dt.month.astype("int8")
+    df["day"] = dates.dt.day.astype("int8")
+    df["x"] = pd.to_numeric(df["x"], errors="coerce")
+    df["y"] = pd.to_numeric(df["y"], errors="coerce")
+    for column in ["plot_file", "operator", "operator_initials", "water_source", "irrigation"]:
+        df[column] = df[column].astype("category")
+    return df
+
+def survey_members(zip_file):
+    """Return the names of the survey XMLs (in the "1" folder) in an open Earth Collect export."""
+    return [name for name in zip_file.namelist() if os.path.dirname(name) == "1" and name.endswith(".xml")]
+
+def parse_members(xml_zip, members, operator_initials, original_location_file=None):
+    """
+    Parse the given XML members of an export zip straight from the zip (nothing is extracted to disk).
+
+    Returns:
+        dict[str, list]: The raw records of all members as columns (see parse_xml).
+    """
+    columns = empty_columns()
+    with zipfile.ZipFile(xml_zip) as zip_file:
+        for member in members:
+            internal_id = int(os.path.splitext(os.path.basename(member))[0]) # The filename without extension
+            with zip_file.open(member) as xml_file:
+                member_columns = parse_xml(xml_file, operator_initials, internal_id, original_location_file)
+            for column in COLUMNS:
+                columns[column].extend(member_columns[column])
+    return columns
+
+def default_location_file(xml_zip):
+    """Return the path of the sample an export was made from, based on the name of the export zip."""
+    group_name = xml_zip.split("/")[-3]
+    sample_range = os.path.basename(xml_zip).split("_")[-1].replace(".zip", "")
+    return f"data/sampling/samples/{group_name}/Zambia_0.05_n_{sample_range}.csv"
+
+def process_xml_zip(xml_zip, original_location_file=None, n_workers=1):
     """
     Processes a ZIP file containing XML files, extracts the data, and converts it into a CSV file.
     Args:
         xml_zip (str): The file path to the ZIP file containing XML files.
+        original_location_file (str, optional): The sample the survey was generated from. Inferred from the name of
+            the zip if not given.
+        n_workers (int): Number of processes to parse the XML files with.
     Returns:
-        list: A list of all records extracted from the XML files.
+        pd.DataFrame: All records extracted from the XML files.
     Functionality:
-        1. Unzips the provided ZIP file into a folder.
-        2. Assumes the XML files are located in a subfolder named "1" within the extracted folder.
-        3. Iterates through all XML files in the folder, parsing their contents.
-        4. Combines the parsed data into a pandas DataFrame.
-        5. Exports the DataFrame to a CSV file in the same directory as the extracted folder.
-        6. Prints the location of the generated CSV file.
+        1. Reads the XML files in the "1" folder of the ZIP file directly from the ZIP file (nothing is unzipped).
+        2. Parses them in n_workers processes, each taking an equal share of the files.
+        3. Validates the dates of all records at once and builds a typed pandas DataFrame (see build_records).
+        4. Exports the DataFrame to a CSV file in the processed folder.
+        5. Prints the location of the generated CSV file.
     """
 
-    # Unzip the folder
-    xml_folder = os.path.splitext(xml_zip)[0]
-    shutil.unpack_archive(xml_zip, xml_folder)
-
-    xml_folder = xml_folder + '/1' # move into the "1" folder
+    # The operator initials are the start of the name of the export
+    operator_initials = os.path.basename(xml_zip).split("_")[0]
 
     # Automatically generate the original_location_file path based on the xml_zip name
     if original_location_file is None:
-        group_name = xml_zip.split("/")[-3]
-        sample_range = os.path.basename(xml_zip).split("_")[-1].replace(".zip", "")
-        original_location_file = f"data/sampling/samples/{group_name}/Zambia_0.05_n_{sample_range}.csv"
+        original_location_file = default_location_file(xml_zip)
+
+    with zipfile.ZipFile(xml_zip) as zip_file:
+        members = survey_members(zip_file)
 
-    all_records = []
-    for filename in os.listdir(xml_folder):
-        if filename.endswith(".xml"):
-            file_path = os.path.join(xml_folder, filename)
-            all_records.extend(parse_xml(file_path, original_location_file))
+    if n_workers > 1 and len(members) > 1:
+        chunks = [members[i::n_workers] for i in range(n_workers) if members[i::n_workers]]
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            parts = list(executor.map(parse_members, [xml_zip] * len(chunks), chunks, [operator_initials] * len(chunks), [original_location_file] * len(chunks)))
+        columns = {column: [value for part in parts for value in part[column]] for column in COLUMNS}
+    else:
+        columns = parse_members(xml_zip, members, operator_initials, original_location_file)
 
     # Create a DataFrame and export to CSV
-    df = pd.DataFrame(all_records)
-    processed_folder = os.path.join(os.path.dirname(xml_zip), "processed")
-    os.makedirs(processed_folder, exist_ok=True)
+    df = build_records(columns)
     output_csv = xml_zip.replace("/raw/", "/processed/").replace(".zip", ".csv")
     os.makedirs(os.path.dirname(output_csv), exist_ok=True)
     df.to_csv(output_csv, index=False)
@@ -145,6 +235,24 @@ def process_xml_zip(xml_zip, original_location_file=None):
     
     return df
 
+def benchmark(xml_zip, original_location_file=None, repeats=3):
+    """
+    Print the time it takes to parse each XML of an export, with and without the id crosswalk. With the crosswalk
+    cached, both should cost about the same (the XML parsing).
+    """
+    with zipfile.ZipFile(xml_zip) as zip_file:
+        members = survey_members(zip_file)
+    if original_location_file is None:
+        original_location_file = default_location_file(xml_zip)
+
+    for label, location_file in [("XML only", None), ("XML + crosswalk", original_location_file)]:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            parse_members(xml_zip, members, "", location_file)
+            times.append(time.perf_counter() - start)
+        print(f"{label}: {min(times) / max(len(members), 1) * 1000:.3f} ms per file ({len(members)} files, best of {repeats})")
+
 if __name__ == '__main__':
 
     # Example usage/test code
@@ -157,8 +265,14 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Process a survey ZIP file exported from Earth Collect into a CSV.")
     parser.add_argument("zip_path", help="Path to the .zip file containing the XML survey export")
+    parser.add_argument("--n_workers", type=int, default=1, help="Number of processes to parse the XML files with")
+    parser.add_argument("--benchmark", action="store_true", help="Time the parsing of each XML file instead of writing the CSV")
 
     args = parser.parse_args()
 
-    df = process_xml_zip(args.zip_path)
+    if args.benchmark:
+        benchmark(args.zip_path)
+        raise SystemExit
+
+    df = process_xml_zip(args.zip_path, n_workers=args.n_workers)
     print(f"Parsed {len(df)} records from {args.zip_path}")
\ No newline at end of file
@@ -0,0 +1,109 @@
+import numpy as np
+from scipy.optimize import brentq
+
+class FenwickSampler:
+    """
+    Draw items with probability proportional to their weight, without replacement.
+
+    Weights are kept in a Fenwick (binary indexed) tree, so drawing an item, removing it and putting it back all
+    take O(log n). This allows a large grid to be sampled one point at a time, and points sampled elsewhere to be
+    removed, without rebuilding anything.
+    """
+
+    def __init__(self, weights):
+        """
+        Build the tree in O(n).
+
+        Parameters:
+            weights (np.ndarray): Non-negative weight of each item.
+        """
+        self.weights = np.array(weights, dtype=np.float64)
+        self.n = len(self.weights)
+
+        # Node i (1-based) holds the sum of the weights in (i - lowbit(i), i]
+        cumulative = np.concatenate([[0.0], np.cumsum(self.weights)])
+        nodes = np.arange(1, self.n + 1)
+        self.tree = np.zeros(self.n + 1)
+        self.tree[1:] = cumulative[nodes] - cumulative[nodes - (nodes & -nodes)]
+        self._top = 1 << (self.n.bit_length() - 1) if self.n else 0
+
+    def total(self):
+        """Return the sum of all weights."""
+        total = 0.0
+        i = self.n
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def set_weight(self, index, weight):
+        """Change the weight of one item (e.g. to 0 to remove it, or back to its original weight)."""
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        i = index + 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, value):
+        """Return the item whose weight interval contains value (the first item with cumulative weight > value)."""
+        position = 0
+        step = self._top
+        while step:
+            if position + step <= self.n and self.tree[position + step] <= value:
+                position += step
+                value -= self.tree[position]
+            step >>= 1
+        return position
+
+    def inclusion_probabilities(self, k):
+        """
+        Approximate the probability that each item is among k items drawn by draw(), given the current weights.
+
+        Uses Rosén's approximation for successive sampling, pi_i = 1 - exp(-t * w_i), with t chosen so that the
+        probabilities sum to k. Unlike k * w_i / W, this accounts for heavy items only being drawn once, and it is
+        within a few thousandths of the exact probabilities in simulations, but it is not exact.
+        """
+        positive = self.weights > 0
+        n_positive = int(positive.sum())
+        if k <= 0:
+            return np.zeros(self.n)
+        if k >= n_positive:
+            return positive.astype(np.float64)
+
+        weights = self.weights[positive]
+        expected_size = lambda t: np.sum(-np.expm1(-t * weights)) - k
+        upper = k / weights.sum()
+        while expected_size(upper) < 0:
+            upper *= 2
+        t = brentq(expected_size, 0.0, upper, xtol=1e-12 * upper)
+
+        probabilities = np.zeros(self.n)
+        probabilities[positive] = -np.expm1(-t * weights)
+        return probabilities
+
+    def draw(self, rng, k):
+        """
+        Draw k items one at a time, removing each one once it is drawn.
+
+        Returns:
+            (np.ndarray, np.ndarray): The drawn items, in draw order, and the probability with which each was drawn
+                given the items drawn before it.
+        """
+        items = np.empty(k, dtype=np.int64)
+        probabilities = np.empty(k)
+        for j in range(k):
+            total = self.total()
+            if total <= 0:
+                raise ValueError(f"Cannot draw {k} items: only {j} have a positive weight.")
+
+            index = self.find(rng.uniform(0, total))
+            if index >= self.n or self.weights[index] <= 0:
+                # Rounding error at the very end of the range
+                index = int(np.flatnonzero(self.weights > 0)[-1])
+
+            items[j] = index
+            probabilities[j] = self.weights[index] / total
+            self.set_weight(index, 0.0)
+
+        return items, probabilities
@@ -0,0 +1,134 @@
+import sys
+import os
+import numpy as np
+from contextlib import contextmanager
+
+# Add the project root to the system path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from src.utils.utils import file_lock
+
+class SampledPointsLedger:
+    """
+    The record of every grid id sampled in a sample group, in the order they were sampled.
+
+    Ids are stored as a flat file of little-endian int64s (sampled_points.bin) that is loaded with mmap, and a
+    sorted copy answers membership queries with a binary search, so the ledger stays fast at millions of points.
+    Appends happen under an exclusive file lock and re-read the ledger first, so two people sampling the same
+    group at the same time cannot interleave writes, sample the same point twice or get overlapping
+    n_{start}-{end} ranges.
+
+    An existing sampled_points.txt (one 'id_<ID>' per line) is imported automatically the first time the ledger
+    is opened. The text file is left in place but is no longer updated.
+    """
+
+    def __init__(self, samples_dir):
+        """
+        Parameters:
+            samples_dir (str): Folder of the sample group (data/sampling/samples/sample_group_name).
+        """
+        self.samples_dir = samples_dir
+        self.path = os.path.join(samples_dir, "sampled_points.bin")
+        self.text_path = os.path.join(samples_dir, "sampled_points.txt")
+        self.lock_path = os.path.join(samples_dir, "sampled_points.lock")
+        self._lock_depth = 0
+        self.refresh()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the exclusive lock on the ledger. Re-entrant within a process.
+        """
+        if self._lock_depth:
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+            return
+
+        with file_lock(self.lock_path):
+            self._lock_depth = 1
+            try:
+                yield
+            finally:
+                self._lock_depth = 0
+
+    def refresh(self):
+        """
+        Reload the ledger from disk (picking up points sampled by other processes), importing the old text
+        ledger first if there is one.
+        """
+        if not os.path.exists(self.path) and os.path.exists(self.text_path):
+            with self.locked():
+                if not os.path.exists(self.path):
+                    self._import_text()
+
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            self.ids = np.memmap(self.path, dtype="<i8", mode="r")
+        else:
+            self.ids = np.empty(0, dtype="<i8")
+        self._sorted_ids = np.sort(self.ids)
+
+    def _import_text(self):
+        """
+        Convert sampled_points.txt to the binary ledger, keeping the first occurrence of any duplicated point
+        (the sample numbering has always counted unique points).
+        """
+        with open(self.text_path, "r") as f:
+            sampled_points = [line.strip() for line in f if line.strip()]
+        if len(set(sampled_points)) < len(sampled_points):
+            print("Warning: There are dublicate sampled points in the list of sampled points. Only the first occurrence of each is kept.")
+
+        ids = np.array([int(point.removeprefix("id_")) for point in sampled_points], dtype="<i8")
+        _, first = np.unique(ids, return_index=True)
+        ids = ids[np.sort(first)]
+
+        # Write to a temporary file first so a crash cannot leave a half-imported ledger
+        tmp_path = self.path + ".tmp"
+        ids.tofile(tmp_path)
+        os.replace(tmp_path, self.path)
+        print(f"Imported {len(ids)} sampled points from {self.text_path}")
+
+    def contains(self, ids):
+        """
+        Return a boolean array that is True for each id that has already been sampled.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(self._sorted_ids, ids)
+        found = positions < len(self._sorted_ids)
+        found[found] = self._sorted_ids[positions[found]] == ids[found]
+        return found
+
+    def append(self, ids):
+        """
+        Append newly sampled ids to the ledger and allocate their range of sample numbers.
+
+        Takes the lock (if it is not already held) and re-reads the ledger first. Callers that draw points and
+        then append them should hold locked() around both so that the draw sees every point sampled so far.
+
+        Returns:
+            (int, int): The 1-based sample numbers of the first and last appended id.
+
+        Raises:
+            ValueError: If any id has already been sampled or appears twice.
+        """
+        ids = np.asarray(ids, dtype="<i8")
+        with self.locked():
+            self.refresh()
+            if self.contains(ids).any() or len(np.unique(ids)) < len(ids):
+                raise ValueError("Cannot add points to the ledger that have already been sampled.")
+
+            start = len(self.ids) + 1
+            with open(self.path, "ab") as f:
+                f.write(ids.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.refresh()
+
+        return start, start + len(ids) - 1
@@ -1,6 +1,6 @@
 # functions to read in agricultural data, resample to 1km, and save the grid's lat/lon coordinates as a csv with info on agriculture and country
 
-# Does NOT include elevation/aspect/slope data yet. 
+# Elevation/aspect/slope are added to the grid separately by terrain.py.
 
 import sys
 import os
@@ -11,16 +11,21 @@ if project_root not in sys.path:
     sys.path.append(project_root)
 
 # Now import the module
-from src.utils.utils import get_data_root, save_data
+from src.utils.utils import get_data_root, save_data, metadata_path
+from src.utils.countries import get_country_index
 
 import rasterio
 from rasterio.warp import calculate_default_transform, reproject, Resampling, transform_geom
+from rasterio.windows import Window
+from affine import Affine
+from rasterio.errors import WindowError
 import numpy as np
 import pandas as pd
 import pyproj
 import matplotlib.pyplot as plt
 import geopandas as gpd
 import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def get_utm_crs(lon, lat):
     """Returns the EPSG code for the appropriate UTM zone based on longitude and latitude."""
@@ -31,167 +36,500 @@ def get_utm_crs(lon, lat):
         epsg_code = 32700 + zone  # Southern Hemisphere
     return pyproj.CRS.from_epsg(epsg_code)
 
-def resample_agriculture_data(src_path, res):
+def agriculture_grid_transform(src, res):
     """
-    Resample the GFSAD agriculture raster dataset (orginical resolution approximately 30m) 
-    to a specified resolution (in meters) and return the lat/lon coordinates
-    of the resampled grid points with the proportion of pixels with value == 2 (cropland). 
-
-    Zero values are removed, retaining only pixels with at least some cropland.
+    Determine the UTM CRS, transform and dimensions of the resampled grid for an open source raster.
 
     Parameters:
-        src_path (str): Path to the source raster file.
+        src (rasterio.DatasetReader): The open source raster.
         res (int): Resolution in meters for the resampled raster.
     """
+    # Determine UTM CRS based on the raster's center
+    center_lon = (src.bounds.left + src.bounds.right) / 2
+    center_lat = (src.bounds.top + src.bounds.bottom) / 2
+    utm_crs = get_utm_crs(center_lon, center_lat)
+
+    # Calculate the new transform and dimensions for the specified resolution
+    transform, width, height = rasterio.warp.calculate_default_transform(
+        src.crs, utm_crs, src.width, src.height, *src.bounds, resolution=(res, res)
+    )
+    return utm_crs, transform, width, height
+
+def grid_windows(width, height, window_size):
+    """
+    Split a grid of the given dimensions into square windows of at most window_size pixels per side.
+    """
+    for row_off in range(0, height, window_size):
+        for col_off in range(0, width, window_size):
+            yield Window(col_off, row_off, min(window_size, width - col_off), min(window_size, height - row_off))
 
-    with rasterio.open(src_path) as src:
-        print("Original CRS:", src.crs)
-        print("Original Bounds:", src.bounds)
-        print("Original Resolution:", src.res)
-
-        # Read the original raster
-        data = src.read(1)
-
-        # Create binary mask where value == 2
-        binary_mask = (data == 2).astype(np.uint8)
-        print("Binary mask created. Non-zero count:", np.count_nonzero(binary_mask))
+def source_window(src, dst_crs, dst_bounds, pad=2):
+    """
+    Return the window of the source raster that covers dst_bounds (given in dst_crs), padded by
+    pad pixels on each side so that edge pixels of the destination window see all of their source pixels.
+    Returns None if the bounds do not overlap the source raster.
+    """
+    left, bottom, right, top = rasterio.warp.transform_bounds(dst_crs, src.crs, *dst_bounds, densify_pts=21)
+    window = rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform)
+    col_off = int(np.floor(window.col_off)) - pad
+    row_off = int(np.floor(window.row_off)) - pad
+    col_end = int(np.ceil(window.col_off + window.width)) + pad
+    row_end = int(np.ceil(window.row_off + window.height)) + pad
+    try:
+        return Window(col_off, row_off, col_end - col_off, row_end - row_off).intersection(Window(0, 0, src.width, src.height))
+    except WindowError:
+        return None
+
+def resample_windows(src, utm_crs, transform, width, height, window_size):
+    """
+    Resample the cropland mask (value == 2) of an open source raster to the destination grid one window at a time.
 
-        # # Plot original binary mask
-        # plt.figure(figsize=(8, 6))
-        # plt.title('Binary Mask (Value == 2)')
-        # plt.imshow(binary_mask, cmap='gray')
-        # plt.colorbar(label='Binary Values')
-        # plt.show()
+    Only the part of the source raster that falls under each destination window is read, so peak memory is set by
+    window_size (in destination pixels) rather than by the size of the tile.
 
-        # Determine UTM CRS based on the raster's center
-        center_lon = (src.bounds.left + src.bounds.right) / 2
-        center_lat = (src.bounds.top + src.bounds.bottom) / 2
-        utm_crs = get_utm_crs(center_lon, center_lat)
-        print("UTM CRS Selected:", utm_crs)
+    Yields:
+        (Window, np.ndarray): The destination window and the proportion of cropland pixels in each of its cells.
+    """
+    for window in grid_windows(width, height, window_size):
+        dst_transform = rasterio.windows.transform(window, transform)
+        resampled_block = np.zeros((window.height, window.width), dtype=np.float32)
+
+        src_window = source_window(src, utm_crs, rasterio.windows.bounds(window, transform))
+        if src_window is not None:
+            binary_mask = (src.read(1, window=src_window) == 2).astype(np.uint8)
+            rasterio.warp.reproject(
+                source=binary_mask,
+                destination=resampled_block,
+                src_transform=src.window_transform(src_window),
+                src_crs=src.crs,
+                dst_transform=dst_transform,
+                dst_crs=utm_crs,
+                resampling=rasterio.warp.Resampling.average
+            )
+
+        yield window, resampled_block
+
+def grid_points(resampled_raster, transform, utm_crs):
+    """
+    Convert a resampled raster (or a window of one, with its window transform) to a DataFrame of the
+    lat/lon coordinates of the center of each cell and the proportion of cropland within it.
+    Zero values are removed.
 
-        # Calculate the new transform and dimensions for the specified resolution
-        transform, width, height = rasterio.warp.calculate_default_transform(
-            src.crs, utm_crs, src.width, src.height, *src.bounds, resolution=(res, res)
-        )
-        print("Resampled Dimensions:", width, height)
+    Only cells with some cropland are transformed: their centers are computed with affine array math
+    and then projected from UTM to WGS84 in one vectorized call.
+    """
 
-        # Prepare an empty array for the resampled raster
-        resampled_raster = np.empty((height, width), dtype=np.float32)
-
-        # Reproject and resample in memory using average resampling
-        rasterio.warp.reproject(
-            source=binary_mask,
-            destination=resampled_raster,
-            src_transform=src.transform,
-            src_crs=src.crs,
-            dst_transform=transform,
-            dst_crs=utm_crs,
-            resampling=rasterio.warp.Resampling.average
-        )
-
-        # # Plot resampled raster
-        # plt.figure(figsize=(8, 6))
-        # plt.title('Resampled Raster (Proportion of Value == 2)')
-        # plt.imshow(resampled_raster, cmap='viridis')
-        # plt.colorbar(label='Proportion of Pixels with Value 2')
-        # plt.show()
+    # Find the cells with at least some cropland before doing any coordinate work
+    rows, cols = np.nonzero(resampled_raster > 0)
+    values = resampled_raster[rows, cols]
 
     # Extract UTM coordinates (center of each pixel)
-    rows, cols = np.meshgrid(np.arange(height), np.arange(width), indexing='ij')
-    xs, ys = rasterio.transform.xy(transform, rows, cols, offset='center')
+    col_centers = cols + 0.5
+    row_centers = rows + 0.5
+    xs = transform.c + col_centers * transform.a + row_centers * transform.b
+    ys = transform.f + col_centers * transform.d + row_centers * transform.e
 
     # Convert UTM coordinates to WGS84 (latitude, longitude)
     transformer = pyproj.Transformer.from_crs(utm_crs, "EPSG:4326", always_xy=True)
-    longitudes, latitudes = transformer.transform(np.array(xs).flatten(), np.array(ys).flatten())
+    longitudes, latitudes = transformer.transform(xs, ys)
 
     # # Debug: Plot points to verify geolocation
     # plt.figure(figsize=(8, 6))
-    # plt.scatter(longitudes, latitudes, c=resampled_raster.flatten(), cmap='viridis', s=1)
+    # plt.scatter(longitudes, latitudes, c=values, cmap='viridis', s=1)
     # plt.colorbar(label='Proportion of Value == 2')
     # plt.title('Reprojected Points (WGS84)')
     # plt.xlabel('Longitude')
     # plt.ylabel('Latitude')
     # plt.show()
 
-    # Flatten values for DataFrame
-    values = resampled_raster.flatten()
-
     # Create DataFrame with lat/lon
     df = pd.DataFrame({
         'latitude': latitudes,
         'longitude': longitudes,
-        'agriculture': values
+        'agriculture': values.astype(np.float32)
     })
 
-    # Filter out zero values
-    df = df[df['agriculture'] > 0]
-
     return df
 
-def add_country(df):
+def aggregate_block(block, factor):
     """
-    Given a DataFrame with lat/lon coordinates, add a column with the country name.
+    Aggregate a block of cropland fractions to a coarser grid by averaging factor x factor cells.
+
+    Cells along the bottom and right edges that do not fill a whole coarse cell are averaged over the
+    fine cells that exist.
     """
+    height, width = block.shape
+    coarse_height, coarse_width = -(-height // factor), -(-width // factor)
+    padded = np.full((coarse_height * factor, coarse_width * factor), np.nan, dtype=np.float32)
+    padded[:height, :width] = block
+    return np.nanmean(padded.reshape(coarse_height, factor, coarse_width, factor), axis=(1, 3)).astype(np.float32)
 
-    # Load country boundaries
-    world = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
+def resample_agriculture_pyramid(src_path, res, factors=(1,), window_size=None, raster_path=None):
+    """
+    Resample the GFSAD agriculture raster dataset (orginical resolution approximately 30m) 
+    to a pyramid of resolutions in a single pass over the source and return, for each level, the lat/lon
+    coordinates of the grid points with the proportion of pixels with value == 2 (cropland).
+
+    The source is only resampled to the finest resolution (res). Each coarser level (res * factor) is built by
+    averaging factor x factor cells of the finest level, so adding a level is a cheap aggregation rather than
+    another pass over the 30 m raster.
+
+    Zero values are removed, retaining only pixels with at least some cropland.
+
+    Parameters:
+        src_path (str): Path to the source raster file.
+        res (int): Resolution in meters of the finest level.
+        factors (tuple): Aggregation factor of each level relative to res (default: (1,), i.e. only res).
+        window_size (int, optional): If given, stream the source raster in windows of window_size x window_size
+            resampled pixels instead of reading the whole tile into memory. Peak memory is then set by the window
+            size (roughly (window_size * res / 30)^2 bytes of source data) rather than by the size of the tile.
+            It is rounded up to a multiple of every factor so that coarse cells never straddle two windows.
+        raster_path (str, optional): If given, the finest level is also written to this GeoTIFF (relative to
+            the data root) window by window as it is computed.
+
+    Returns:
+        dict: Maps the resolution of each level (res * factor) to its DataFrame of grid points.
+    """
+
+    with rasterio.open(src_path) as src:
+        print("Original CRS:", src.crs)
+        print("Original Bounds:", src.bounds)
+        print("Original Resolution:", src.res)
 
-    # Create a GeoDataFrame from the DataFrame
-    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.longitude, df.latitude))
+        utm_crs, transform, width, height = agriculture_grid_transform(src, res)
+        print("UTM CRS Selected:", utm_crs)
+        print("Resampled Dimensions:", width, height)
 
-    # Perform a spatial join
-    gdf = gpd.sjoin(gdf, world, how='left', op='within')
+        if window_size is None:
+            # Read the original raster
+            data = src.read(1)
+
+            # Create binary mask where value == 2
+            binary_mask = (data == 2).astype(np.uint8)
+            print("Binary mask created. Non-zero count:", np.count_nonzero(binary_mask))
+
+            # # Plot original binary mask
+            # plt.figure(figsize=(8, 6))
+            # plt.title('Binary Mask (Value == 2)')
+            # plt.imshow(binary_mask, cmap='gray')
+            # plt.colorbar(label='Binary Values')
+            # plt.show()
+
+            # Prepare an empty array for the resampled raster (cells the source does not reach stay at 0)
+            resampled_raster = np.zeros((height, width), dtype=np.float32)
+
+            # Reproject and resample in memory using average resampling
+            rasterio.warp.reproject(
+                source=binary_mask,
+                destination=resampled_raster,
+                src_transform=src.transform,
+                src_crs=src.crs,
+                dst_transform=transform,
+                dst_crs=utm_crs,
+                resampling=rasterio.warp.Resampling.average
+            )
+
+            # # Plot resampled raster
+            # plt.figure(figsize=(8, 6))
+            # plt.title('Resampled Raster (Proportion of Value == 2)')
+            # plt.imshow(resampled_raster, cmap='viridis')
+            # plt.colorbar(label='Proportion of Pixels with Value 2')
+            # plt.show()
+
+            blocks = [(Window(0, 0, width, height), resampled_raster)]
+        else:
+            # Round up to a multiple of every factor, so the window (and its memory) grows by less than one coarse cell
+            multiple = int(np.lcm.reduce(factors))
+            window_size = -(-window_size // multiple) * multiple
+            print("Resampling in windows of", window_size, "x", window_size, "pixels")
+            blocks = resample_windows(src, utm_crs, transform, width, height, window_size)
+
+        dst = None
+        if raster_path:
+            raster_path = os.path.join(get_data_root(), raster_path)
+            os.makedirs(os.path.dirname(raster_path), exist_ok=True)
+            dst = rasterio.open(
+                raster_path, 'w', driver='GTiff', height=height, width=width, count=1, dtype='float32',
+                crs=utm_crs, transform=transform, tiled=True, blockxsize=256, blockysize=256, compress='deflate'
+            )
+
+        # Convert each (window of the) resampled raster to points for every level as it is produced
+        frames = {factor: [] for factor in factors}
+        try:
+            for window, block in blocks:
+                if dst is not None:
+                    dst.write(block, 1, window=window)
+                for factor in factors:
+                    if factor == 1:
+                        frames[factor].append(grid_points(block, rasterio.windows.transform(window, transform), utm_crs))
+                        continue
+                    coarse_window = Window(window.col_off // factor, window.row_off // factor,
+                                           -(-window.width // factor), -(-window.height // factor))
+                    coarse_transform = transform * Affine.scale(factor)
+                    frames[factor].append(grid_points(aggregate_block(block, factor),
+                                                      rasterio.windows.transform(coarse_window, coarse_transform), utm_crs))
+        finally:
+            if dst is not None:
+                dst.close()
+
+    return {res * factor: pd.concat(frames[factor], ignore_index=True) for factor in factors}
+
+def resample_agriculture_data(src_path, res, window_size=None, raster_path=None):
+    """
+    Resample the GFSAD agriculture raster dataset (orginical resolution approximately 30m) 
+    to a specified resolution (in meters) and return the lat/lon coordinates
+    of the resampled grid points with the proportion of pixels with value == 2 (cropland). 
 
-    # rename the 'name' column to 'country'
-    gdf.rename(columns={'name': 'country'}, inplace=True)
+    Zero values are removed, retaining only pixels with at least some cropland.
+
+    Parameters:
+        src_path (str): Path to the source raster file.
+        res (int): Resolution in meters for the resampled raster.
+        window_size (int, optional): If given, stream the source raster in windows (see resample_agriculture_pyramid).
+        raster_path (str, optional): If given, the resampled raster is also written to this GeoTIFF (relative to
+            the data root) window by window as it is computed.
+    """
+    return resample_agriculture_pyramid(src_path, res, window_size=window_size, raster_path=raster_path)[res]
+
+def add_country(df, country_index=None):
+    """
+    Given a DataFrame with lat/lon coordinates, add a column with the country name.
+
+    Countries are assigned with a rasterized CountryIndex (see src/utils/countries.py), which is built once per
+    process and reused for every tile. Points that are not inside any country get no country, as before.
+    """
+
+    # Load the country lookup index (built on first use)
+    if country_index is None:
+        country_index = get_country_index()
+
+    df = df.copy()
+    df['country'] = country_index.lookup(df['longitude'].to_numpy(), df['latitude'].to_numpy())
 
     # Only keep latitude, longitude, agriculture, and country columns
-    gdf = gdf[['latitude', 'longitude', 'agriculture', 'country']]
+    df = df[['latitude', 'longitude', 'agriculture', 'country']]
 
-    return pd.DataFrame(gdf)
+    return df
 
-def process_and_combine_ag_data(ag_data_loc, res):
+def window_size_for_budget(src_path, res, max_memory_mb):
     """
-    Process the agricultural data and combine with country information.
+    Return the largest window size (in resampled pixels) whose source block fits within max_memory_mb.
+
+    Each source pixel costs roughly 4 bytes while a window is being resampled (the raw block, the binary mask and
+    GDAL's warp buffers), and one resampled pixel covers (res / source resolution)^2 source pixels.
     """
+    with rasterio.open(src_path) as src:
+        xres, yres = src.res
+        if src.crs.is_geographic:
+            # Convert degrees to approximate meters at the center of the tile
+            center_lat = (src.bounds.top + src.bounds.bottom) / 2
+            xres = xres * 111320 * np.cos(np.radians(center_lat))
+            yres = yres * 110540
 
-    # Get a list of all tif files at ag_data_loc
-    files = [f for f in os.listdir(ag_data_loc) if f.endswith('.tif')]
+    src_pixels_per_cell = (res / xres) * (res / yres)
+    return max(1, int(np.sqrt(max_memory_mb * 1024 ** 2 / (4 * src_pixels_per_cell))))
+
+def tile_output_path(filename, level_res, res):
+    """
+    Path (relative to the data root) of the per-tile grid for one level of the pyramid.
+    The finest level keeps its original location, sampling/grid/{tile}.csv.
+    """
+    if level_res == res:
+        return f'sampling/grid/{filename}.csv'
+    return f'sampling/grid/{level_res}m/{filename}.csv'
 
-    # Initialize an empty DataFrame
-    full_df = pd.DataFrame()
+def process_tile(src_path, res, window_size=None, max_memory_mb=None, factors=(1,)):
+    """
+    Resample a single GFSAD tile to every level of the pyramid, add country information and save each level
+    (see tile_output_path).
 
-    # for each file, resample the data and add country information. 
-    for file in files:
-        df = resample_agriculture_data(ag_data_loc + file, res)
+    This is the unit of work for process_and_combine_ag_pyramid, so it must stay a top-level function
+    that can be sent to worker processes.
+
+    Parameters:
+        src_path (str): Path to the source raster file.
+        res (int): Resolution in meters of the finest level.
+        window_size (int, optional): Window size passed to resample_agriculture_pyramid.
+        max_memory_mb (int, optional): Memory budget for this worker. If given (and window_size is not),
+            the window size is chosen so that a window of source data fits within the budget.
+        factors (tuple): Aggregation factor of each level relative to res.
+
+    Returns:
+        dict: Maps the resolution of each level to its DataFrame.
+    """
+    if window_size is None and max_memory_mb is not None:
+        window_size = window_size_for_budget(src_path, res, max_memory_mb)
+
+    levels = resample_agriculture_pyramid(src_path, res, factors=factors, window_size=window_size)
+    filename, _ = os.path.splitext(os.path.basename(src_path))
+    for level_res, df in levels.items():
         df = add_country(df)
+        save_data(df, tile_output_path(filename, level_res, res), description=f'Agriculture Data Resampled to {level_res}m Grid', file_format='csv')
+        levels[level_res] = df
+
+    return levels
+
+def process_and_combine_ag_pyramid(ag_data_loc, res, factors=(1,), window_size=None, n_workers=1, max_memory_mb=None, overwrite=False):
+    """
+    Process the agricultural data into a pyramid of resolutions and combine with country information.
+
+    Tiles are processed independently (see process_tile), in parallel across n_workers processes if n_workers > 1.
+    The run is restartable: tiles that already have complete outputs (with their metadata file) for every level
+    (sampling/grid/{tile}.csv for the finest) are read back instead of being reprocessed, unless overwrite is True.
+
+    Parameters:
+        ag_data_loc (str): Folder containing the GFSAD .tif tiles.
+        res (int): Resolution in meters of the finest level.
+        factors (tuple): Aggregation factor of each level relative to res, e.g. (1, 5, 10) for 1, 5 and 10 km.
+        window_size (int, optional): If given, each tile is resampled in windows of that many output pixels (see resample_agriculture_pyramid).
+        n_workers (int): Number of worker processes (default: 1, i.e. process tiles one after another).
+        max_memory_mb (int, optional): Memory budget per worker, used to pick the window size when window_size is not given.
+        overwrite (bool): Reprocess tiles even if their output already exists.
+
+    Returns:
+        dict: Maps the resolution of each level to the combined DataFrame for that level.
+    """
+
+    # Get a list of all tif files at ag_data_loc
+    files = sorted(f for f in os.listdir(ag_data_loc) if f.endswith('.tif'))
+    level_resolutions = [res * factor for factor in factors]
+
+    # Collect the per-tile results by file so the combined grid is in a stable order
+    tile_levels = {}
+    pending = []
+    for file in files:
         filename, _ = os.path.splitext(file)
-        save_data(df, f'sampling/grid/{filename}.csv', description=f'Agriculture Data Resampled to {res}m Grid', file_format='csv')
+        output_paths = {level_res: os.path.join(get_data_root(), tile_output_path(filename, level_res, res)) for level_res in level_resolutions}
+        # save_data writes each output atomically and its metadata last, so a tile interrupted part way through
+        # (or a truncated file left by an older version) is processed again
+        if all(os.path.exists(path) and os.path.exists(metadata_path(path)) for path in output_paths.values()) and not overwrite:
+            print(f"Grid for {filename} already exists. Skipping.")
+            tile_levels[file] = {level_res: pd.read_csv(path) for level_res, path in output_paths.items()}
+        else:
+            pending.append(file)
+
+    # for each remaining file, resample the data and add country information.
+    if n_workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                executor.submit(process_tile, os.path.join(ag_data_loc, file), res, window_size, max_memory_mb, factors): file
+                for file in pending
+            }
+            for future in as_completed(futures):
+                tile_levels[futures[future]] = future.result()
+                print(f"Finished {futures[future]} ({len(tile_levels)}/{len(files)} tiles)")
+    else:
+        for file in pending:
+            tile_levels[file] = process_tile(os.path.join(ag_data_loc, file), res, window_size, max_memory_mb, factors)
+
+    # Combine the data once all tiles are done
+    return {
+        level_res: pd.concat([tile_levels[file][level_res] for file in files if file in tile_levels], ignore_index=True)
+        for level_res in level_resolutions
+    }
 
-        # Combine the data
-        full_df = pd.concat([full_df, df])
+def process_and_combine_ag_data(ag_data_loc, res, window_size=None, n_workers=1, max_memory_mb=None, overwrite=False):
+    """
+    Process the agricultural data and combine with country information.
 
-    return full_df
+    See process_and_combine_ag_pyramid for the parameters; this builds only the res level.
+    """
+    return process_and_combine_ag_pyramid(ag_data_loc, res, window_size=window_size, n_workers=n_workers,
+                                          max_memory_mb=max_memory_mb, overwrite=overwrite)[res]
 
 def add_id(df):
     """
-    Add a unique ID to the DataFrame.
+    Add a unique integer ID to the DataFrame.
+
+    Samples still refer to grid cells as 'id_<ID>' (see SampleGenerator), but the grid itself stores the integer.
     """
 
     # Add a unique ID
-    df['id'] = ['id_' + str(i) for i in range(len(df))]
+    df['id'] = np.arange(len(df), dtype=np.int64)
 
     # Make ID the first column
     df = df[['id'] + [col for col in df.columns if col != 'id']]
 
     return df
+
+def compact_grid(df):
+    """
+    Cast the grid to compact dtypes for columnar storage: float32 agriculture and categorical country.
+    """
+    df = df.copy()
+    df['agriculture'] = df['agriculture'].astype(np.float32)
+    df['country'] = df['country'].astype('category')
+    return df
+
+def grid_arrays(df, score_columns=None):
+    """
+    Convert the grid to the flat arrays of a memory-mapped grid (see save_data(..., file_format='mmap') and
+    SampleGenerator), so that any number of sampler processes can share one copy of it through the page cache.
+
+    Rows are sorted by country (rows without a country last) and then id, and the indexes the sampler needs are
+    precomputed so that loading the grid does not allocate anything per row.
+
+    Parameters:
+        df (pd.DataFrame): The grid, with id, latitude, longitude, agriculture and country columns.
+        score_columns (list, optional): Extra columns to include (e.g. targeting model scores).
+
+    Returns:
+        dict: Array name -> np.ndarray.
+    """
+    country = df['country'].astype('category')
+    names = np.asarray(country.cat.categories, dtype=str)
+    codes = country.cat.codes.to_numpy()
+    key = np.where(codes < 0, len(names), codes)
+
+    order = np.lexsort((df['id'].to_numpy(), key))
+    key = key[order]
+    agriculture = df['agriculture'].to_numpy(dtype=np.float32)[order]
+
+    arrays = {
+        'id': df['id'].to_numpy(dtype=np.int64)[order],
+        'latitude': df['latitude'].to_numpy(dtype=np.float64)[order],
+        'longitude': df['longitude'].to_numpy(dtype=np.float64)[order],
+        'agriculture': agriculture,
+        'country_code': codes[order],  # Same dtype pandas picks for the codes, so Categorical.from_codes keeps them on the mmap
+        'country_names': names,
+        # Rows of country i are country_offsets[i]:country_offsets[i + 1]; rows without a country come last
+        'country_offsets': np.searchsorted(key, np.arange(len(names) + 2)).astype(np.int64),
+    }
+    for column in score_columns or []:
+        arrays[column] = df[column].to_numpy()[order]
+
+    # Row positions sorted by agriculture, overall and within each country, with the sorted values
+    arrays['agriculture_order'] = np.argsort(agriculture, kind='stable')
+    arrays['agriculture_sorted'] = agriculture[arrays['agriculture_order']]
+    arrays['country_agriculture_order'] = np.lexsort((agriculture, key))
+    arrays['country_agriculture_sorted'] = agriculture[arrays['country_agriculture_order']]
+
+    # Ids in sorted order, to map ledger ids back to rows
+    arrays['id_order'] = np.argsort(arrays['id'], kind='stable')
+    arrays['id_sorted'] = arrays['id'][arrays['id_order']]
+    return arrays
     
 
 if __name__ == '__main__':
 
     ag_data_loc = get_data_root() + '/sampling/raw/GFSAD/GFSAD30AFCE_001-20250206_011249/'
-    df = process_and_combine_ag_data(ag_data_loc, 1000) # 1km resolution
-    df = add_id(df)
-
-    # Save the data
-    save_data(df, 'sampling/grid/combined/agriculture_grid.csv', description='Agriculture Data Resampled to 1km Grid', file_format='csv')
\ No newline at end of file
+    res = 1000 # 1km resolution for sampling
+    factors = (1, 5, 10) # plus 5km and 10km levels for targeting maps
+    levels = process_and_combine_ag_pyramid(ag_data_loc, res, factors=factors, n_workers=os.cpu_count(), max_memory_mb=2048)
+
+    # Each level is its own dataset; the metadata of every level links to the rest of the pyramid
+    level_paths = {
+        level_res: 'sampling/grid/combined/agriculture_grid.parquet' if level_res == res else f'sampling/grid/combined/agriculture_grid_{level_res}m.parquet'
+        for level_res in levels
+    }
+    for level_res, df in levels.items():
+        df = add_id(df)
+        df = compact_grid(df)
+
+        # Save the data as a Parquet dataset partitioned by country, so samplers only need to read the countries they use
+        pyramid = {"resolution": level_res, "base_resolution": res, "levels": {f"{r}m": path for r, path in level_paths.items()}}
+        save_data(df, level_paths[level_res], description=f'Agriculture Data Resampled to {level_res}m Grid', file_format='parquet', partition_cols=['country'], extra_metadata={"pyramid": pyramid})
+
+        # The sampling grid is also saved as memory-mapped arrays that parallel sampler processes can share
+        if level_res == res:
+            save_data(grid_arrays(df), 'sampling/grid/combined/agriculture_grid_arrays.mmap', description=f'Agriculture Data Resampled to {level_res}m Grid, as memory-mappable arrays', file_format='mmap')
@@ -1,6 +1,11 @@
 import sys
 import os
+import itertools
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from scipy.spatial import cKDTree
 
 # Add the project root to the system path
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
@@ -8,58 +13,409 @@ if project_root not in sys.path:
     sys.path.append(project_root)
 
 from src.utils.utils import get_data_root, save_data
+from src.utils.countries import get_country_index
+from src.sampling.ledger import SampledPointsLedger
+from src.sampling.fenwick import FenwickSampler
+
+# Columns of the grid used for sampling
+GRID_COLUMNS = ['id', 'latitude', 'longitude', 'agriculture', 'country']
+
+def format_id(grid_id):
+    """Format an integer grid id the way it appears in samples and surveys (e.g. 'id_123')."""
+    return f"id_{grid_id}"
+
+# All orderings of the four quadrants of a cell, used to randomize the GRTS addresses
+QUADRANT_PERMUTATIONS = np.array(list(itertools.permutations(range(4))))
+
+def grts_rank(x, y, rng, levels=20):
+    """
+    Rank points in a randomized hierarchical (GRTS) order.
+
+    The bounding square of the points is split recursively into quadrants, and each point gets an address from
+    the quadrants it falls in at every level. At each level the quadrants of a cell are numbered in a random order
+    that differs from cell to cell. Sorting by address gives an order in which points that are close together
+    are close in the order, but which part of the area comes first is random. Systematic samples taken along
+    this order are spread evenly over space.
+
+    Parameters:
+        x, y (np.ndarray): Projected coordinates of the points.
+        rng (np.random.Generator): Random number generator used to randomize the quadrant order and break ties.
+        levels (int): Number of levels of the quadtree (at most 31).
+
+    Returns:
+        np.ndarray: The rank of each point in the order.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    size = max(x.max() - x.min(), y.max() - y.min()) or 1.0
+    cells = 2 ** levels
+    gx = np.minimum(((x - x.min()) / size * cells).astype(np.uint64), cells - 1)
+    gy = np.minimum(((y - y.min()) / size * cells).astype(np.uint64), cells - 1)
+
+    seed = np.uint64(rng.integers(0, 2 ** 63))
+    address = np.zeros(len(x), dtype=np.uint64)
+    parent = np.zeros(len(x), dtype=np.uint64)
+    for level in range(levels):
+        shift = np.uint64(levels - 1 - level)
+        quadrant = ((gx >> shift) & np.uint64(1)) | (((gy >> shift) & np.uint64(1)) << np.uint64(1))
+
+        # Pick a quadrant order for each parent cell by hashing its (unrandomized) address
+        with np.errstate(over='ignore'):
+            h = (parent + np.uint64(level + 1)) * np.uint64(0x9E3779B97F4A7C15) ^ seed
+            h ^= h >> np.uint64(31)
+            h *= np.uint64(0xBF58476D1CE4E5B9)
+            h ^= h >> np.uint64(29)
+        digit = QUADRANT_PERMUTATIONS[(h % np.uint64(24)).astype(np.int64), quadrant.astype(np.int64)]
+
+        address = (address << np.uint64(2)) | digit.astype(np.uint64)
+        parent = (parent << np.uint64(2)) | quadrant
+
+    # Points that share a cell at the finest level are ordered randomly
+    order = np.lexsort((rng.random(len(x)), address))
+    rank = np.empty(len(x), dtype=np.int64)
+    rank[order] = np.arange(len(x))
+    return rank
+
+def load_grid_arrays(grid_path, countries=None, score_columns=None):
+    """
+    Load a memory-mapped grid (written by save_data(grid_arrays(df), ..., file_format='mmap')) without copying it.
+
+    Every array is mapped read-only, so sampler processes that load the same grid share one copy of it in the
+    page cache. The whole grid is always mapped; countries only restricts the index used to draw points.
+
+    Returns:
+        (pd.DataFrame, dict, np.ndarray, np.ndarray): The grid, the agriculture index (see
+            SampleGenerator._build_index), and the grid ids in sorted order with their row positions.
+    """
+    def load(name):
+        return np.load(os.path.join(grid_path, f"{name}.npy"), mmap_mode='r')
+
+    names = [str(name) for name in load('country_names')]
+    offsets = load('country_offsets')
+    columns = {column: load(column) for column in ['id', 'latitude', 'longitude', 'agriculture'] + list(score_columns or [])}
+    # The codes were written from a pandas Categorical (see make_grid.grid_arrays), so they are valid and not scanned again
+    columns['country'] = pd.Categorical.from_codes(load('country_code'), categories=names, validate=False)
+    grid = pd.DataFrame(columns, copy=False)
+
+    country_order = load('country_agriculture_order')
+    country_sorted = load('country_agriculture_sorted')
+    index = {
+        name: (country_order[offsets[i]:offsets[i + 1]], country_sorted[offsets[i]:offsets[i + 1]])
+        for i, name in enumerate(names) if not countries or name in countries
+    }
+    if not countries:
+        index["All"] = (load('agriculture_order'), load('agriculture_sorted'))
+    else:
+        # Only the selected countries are merged into a new "All" index
+        order = np.concatenate([index[name][0] for name in index]) if index else np.empty(0, dtype=np.int64)
+        order = order[np.argsort(grid['agriculture'].to_numpy()[order], kind='stable')]
+        index["All"] = (order, grid['agriculture'].to_numpy()[order])
+
+    return grid, index, load('id_sorted'), load('id_order')
+
+EARTH_RADIUS_KM = 6371.0088
+
+def to_cartesian_km(latitude, longitude):
+    """
+    Convert lat/lon to 3D cartesian coordinates (in km) on a spherical Earth, so that straight-line (chord)
+    distances can be used in a KD-tree.
+    """
+    lat = np.radians(np.asarray(latitude, dtype=np.float64))
+    lon = np.radians(np.asarray(longitude, dtype=np.float64))
+    return EARTH_RADIUS_KM * np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def chord_km(distance_km):
+    """Straight-line distance between two points that are distance_km apart along the surface of the Earth."""
+    return 2 * EARTH_RADIUS_KM * np.sin(distance_km / (2 * EARTH_RADIUS_KM))
 
 class SampleGenerator:
     """A class to manage sampling from a spatial grid while tracking unique IDs."""
 
-    def __init__(self, grid_path, sample_group_name):
+    def __init__(self, grid_path, sample_group_name, countries=None, seed=None, score_columns=None):
         """
         Initialize the sample generator.
 
         Parameters:
-            grid_path (str): Path to the full grid CSV file.
+            grid_path (str): Path to the full grid: a CSV file, a Parquet dataset partitioned by country, or a
+                directory of memory-mapped arrays (.mmap, see load_grid_arrays) that is shared between processes.
             sample_group_name (str): Name of the sample group (used for organizing saved files). 
+            countries (list, optional): Only load these countries. For a partitioned Parquet grid only the matching
+                partitions are read.
+            seed (int, optional): Seed for the random number generator used to draw samples.
+            score_columns (list, optional): Extra columns of the grid to load (e.g. a targeting model probability)
+                so that they can be used as weights with method="weighted".
             
-        Every sample group has (or will have) a file within it that tracks all points that have already been sampled so that they are not repeated in subsequent samples. 
+        Every sample group has (or will have) a ledger within it that tracks all points that have already been sampled so that they are not repeated in subsequent samples (see SampledPointsLedger). 
         
         Samples are saved under data/sampling/samples/sample_group_name/ with the filename being the country name, ag_thresh, and the range of sampled points.
         """
         self.grid_path = grid_path
-        self.grid = pd.read_csv(grid_path)  # Load the grid once into memory
+        if grid_path.endswith('.mmap'):
+            self.grid, self._index, self._sorted_ids, self._id_order = load_grid_arrays(grid_path, countries, score_columns)
+        else:
+            self.grid = self._load_grid(grid_path, countries, score_columns).reset_index(drop=True)  # Load the grid once into memory
+            self._index = None
+
+        # Grids saved without country information get it from the shared country index
+        if 'country' not in self.grid.columns:
+            self.grid['country'] = get_country_index().lookup(self.grid['longitude'].to_numpy(), self.grid['latitude'].to_numpy())
         self.sample_group_name = sample_group_name
         self.samples_dir = os.path.join(get_data_root(), f"sampling/samples/{self.sample_group_name}")
-        self.sampled_points_file = self.samples_dir + "/sampled_points.txt"
-        self.sampled_points = self._get_sampled_points()  # Load the last used ID
+        self.ledger = SampledPointsLedger(self.samples_dir)  # Load the points sampled so far
+
+        # Previously sampled points are masked out of the grid rather than removed from it
+        if self._index is None:
+            self._id_order = np.argsort(self.grid['id'].to_numpy(), kind='stable')
+            self._sorted_ids = self.grid['id'].to_numpy()[self._id_order]
+            self._build_index()
+        self.available = ~self.ledger.contains(self.grid['id'].to_numpy())
+        self._ledger_length = len(self.ledger)
+
+        self.rng = np.random.default_rng(seed)
+        self._grts_rank = None  # Computed the first time a spatially balanced sample is drawn
+        self._grts_lines = {}
+        self._weighted_samplers = {}  # Built the first time each weighted sample is drawn
+        self._draw_probabilities = {}
+        self._draw_count = 0
+
+    def _load_grid(self, grid_path, countries=None, score_columns=None):
+        """
+        Load the columns of the grid needed for sampling (and any score columns), with integer ids.
+        """
+        columns = GRID_COLUMNS + [c for c in (score_columns or []) if c not in GRID_COLUMNS]
+        if grid_path.endswith('.parquet'):
+            # Predicate pushdown on the country partitions. The partition values are read as plain strings
+            # because pyarrow cannot combine dictionary-encoded partitions when some points have no country.
+            filters = [('country', 'in', list(countries))] if countries else None
+            partitioning = ds.partitioning(pa.schema([('country', pa.string())]), flavor='hive')
+            grid = pd.read_parquet(grid_path, columns=columns, filters=filters, partitioning=partitioning)
+            grid['country'] = grid['country'].astype('category')
+        else:
+            grid = pd.read_csv(grid_path, usecols=lambda c: c in columns)
+            if countries and 'country' in grid.columns:
+                grid = grid[grid['country'].isin(countries)]
+
+        # Older grids store ids as 'id_<ID>' strings
+        if not pd.api.types.is_integer_dtype(grid['id']):
+            grid['id'] = grid['id'].str.removeprefix('id_').astype(np.int64)
+
+        return grid
+
+    def _build_index(self):
+        """
+        Index the grid rows of each country (and of "All") sorted by agriculture, so that the rows above an
+        agriculture threshold are found with a binary search instead of a scan over the whole grid.
+        """
+        agriculture = self.grid['agriculture'].to_numpy()
+        country = self.grid['country'].astype('category')
+        codes = country.cat.codes.to_numpy()
+
+        # self._index[country] = (grid row positions, their agriculture values), both sorted by agriculture
+        order = np.argsort(agriculture, kind='stable')
+        self._index = {"All": (order, agriculture[order])}
+
+        order = np.lexsort((agriculture, codes))
+        bounds = np.searchsorted(codes[order], np.arange(len(country.cat.categories) + 1))
+        for code, name in enumerate(country.cat.categories):
+            positions = order[bounds[code]:bounds[code + 1]]
+            self._index[name] = (positions, agriculture[positions])
+
+    def _eligible(self, country, ag_thresh):
+        """
+        Return the grid row positions in country with agriculture > ag_thresh that have not been sampled yet.
+        """
+        positions, agriculture = self._index.get(country, (np.empty(0, dtype=np.int64), np.empty(0)))
+        positions = positions[np.searchsorted(agriculture, ag_thresh, side='right'):]
+        return positions[self.available[positions]]
+
+    def _draw(self, num_samples, country, ag_thresh, method="random", n_batches=1, weight_column="agriculture"):
+        """
+        Draw num_samples grid row positions without replacement from the eligible, not yet sampled rows.
+
+        For method="grts" the positions are interleaved so that each of the n_batches consecutive slices of
+        num_samples / n_batches positions is itself a spatially balanced sample.
+        """
+        if method == "grts":
+            return self._draw_grts(num_samples, country, ag_thresh, n_batches)
+        if method == "weighted":
+            return self._draw_weighted(num_samples, country, ag_thresh, weight_column)
+        if method != "random":
+            raise ValueError(f"Unknown sampling method: {method}")
+
+        eligible = self._eligible(country, ag_thresh)
+        if num_samples > len(eligible):
+            raise ValueError(f"Cannot take {num_samples} samples: only {len(eligible)} unsampled grid points in {country} have more than {ag_thresh} agriculture.")
+        return self.rng.choice(eligible, size=num_samples, replace=False)
 
-        # Remove previously sampled points from the grid
-        self.grid = self.grid[~self.grid['id'].isin(self.sampled_points)]
+    def _draw_spaced(self, num_samples, country, ag_thresh, method="random", n_batches=1, min_spacing_km=None, weight_column="agriculture"):
+        """
+        Draw like _draw, but keep every drawn point at least min_spacing_km from the other drawn points and from
+        every point sampled earlier in the group.
 
-    def _get_sampled_points(self):
+        Earlier points go into a KD-tree, and candidates are checked against it in one vectorized query.
+        Candidates are accepted greedily in draw order, and replacements are drawn for the rejected ones. Only the
+        earlier and newly drawn points are indexed, never the whole grid, so this stays fast on large grids.
         """
-        Load the set of previously sampled points from file.
+        if not min_spacing_km:
+            return self._draw(num_samples, country, ag_thresh, method=method, n_batches=n_batches, weight_column=weight_column)
+
+        latitude = self.grid['latitude'].to_numpy()
+        longitude = self.grid['longitude'].to_numpy()
+        radius = chord_km(min_spacing_km)
+
+        # Points sampled earlier in this group (that are in the loaded grid)
+        previous = np.flatnonzero(~self.available)
+        previous_tree = cKDTree(to_cartesian_km(latitude[previous], longitude[previous])) if len(previous) else None
+
+        chosen = []
+        chosen_xyz = np.empty((0, 3))
+        drawn = []
+        try:
+            while len(chosen) < num_samples:
+                # Replacement rounds draw a single batch
+                batches = n_batches if not drawn else 1
+                candidates = self._draw(num_samples - len(chosen), country, ag_thresh, method=method, n_batches=batches, weight_column=weight_column)
+
+                # Candidates are set aside while drawing replacements, so they are not drawn again
+                self.available[candidates] = False
+                drawn.append(candidates)
+
+                xyz = to_cartesian_km(latitude[candidates], longitude[candidates])
+                if previous_tree is not None:
+                    distance, _ = previous_tree.query(xyz, distance_upper_bound=radius)
+                    far_from_previous = distance >= radius
+                else:
+                    far_from_previous = np.ones(len(candidates), dtype=bool)
+
+                for position, point, keep in zip(candidates, xyz, far_from_previous):
+                    if keep and (len(chosen_xyz) == 0 or np.min(np.linalg.norm(chosen_xyz - point, axis=1)) >= radius):
+                        chosen.append(position)
+                        chosen_xyz = np.vstack([chosen_xyz, point])
+        finally:
+            # Only the chosen points are taken out of the grid (by the caller); give back the rejected ones
+            for candidates in drawn:
+                self.available[candidates] = True
+
+        return np.array(chosen, dtype=np.int64)
+
+    def _grts_line(self, country, ag_thresh):
         """
-        if os.path.exists(self.sampled_points_file):
-            with open(self.sampled_points_file, "r") as f:
-                sampled_points = f.read().strip().split("\n")
-                if len(set(sampled_points)) < len(sampled_points):
-                    print("Warning: There are dublicate sampled points in the list of sampled points. This can cause issues with the numbering of the samples.")
-                return set(sampled_points)
-        return set()
-    
-    def _update_sampled_points(self, new_sampled_points):
-        """Update the set of sampled points in the tracking file."""
+        Return the rows of country with agriculture > ag_thresh in GRTS order, with the cumulative sum of
+        their agriculture. Built once per (country, ag_thresh) and reused for every later draw.
+        """
+        key = (country, ag_thresh)
+        if key not in self._grts_lines:
+            if self._grts_rank is None:
+                # Project to roughly equal-area coordinates before building the quadtree
+                latitude = self.grid['latitude'].to_numpy()
+                longitude = self.grid['longitude'].to_numpy()
+                self._grts_rank = grts_rank(longitude * np.cos(np.radians(latitude)), latitude, self.rng)
 
-        # Ensure the directory exists before writing
-        os.makedirs(os.path.dirname(self.sampled_points_file), exist_ok=True)
+            positions, agriculture = self._index.get(country, (np.empty(0, dtype=np.int64), np.empty(0)))
+            positions = positions[np.searchsorted(agriculture, ag_thresh, side='right'):]
+            positions = positions[np.argsort(self._grts_rank[positions])]
+            cumulative_weights = np.cumsum(self.grid['agriculture'].to_numpy()[positions], dtype=np.float64)
+            self._grts_lines[key] = (positions, cumulative_weights)
 
-        # Write the new sampled points to the file
-        with open(self.sampled_points_file, "a") as f:
-            f.write("\n".join(new_sampled_points) + "\n")
+        return self._grts_lines[key]
 
-        # Update the set of sampled points in the class
-        self.sampled_points = set(self.sampled_points).union(new_sampled_points)
+    def _draw_grts(self, num_samples, country, ag_thresh, n_batches=1):
+        """
+        Draw a spatially balanced sample with inclusion probability proportional to agriculture.
 
-    def sample(self, num_samples, country="All", ag_thresh=0.05):
+        The eligible rows are laid out along a line in GRTS order, each taking up a length equal to its
+        agriculture, and a systematic sample of num_samples points is taken along the line with a random start.
+        Hits on rows that have already been sampled move on to the next available row in GRTS order, so the
+        ledger is respected without rebuilding the line; each draw costs O(num_samples).
+        """
+        positions, cumulative_weights = self._grts_line(country, ag_thresh)
+        if len(positions) == 0 or cumulative_weights[-1] <= 0:
+            raise ValueError(f"Cannot take {num_samples} samples: there are no grid points in {country} with more than {ag_thresh} agriculture.")
+
+        step = cumulative_weights[-1] / num_samples
+        targets = self.rng.uniform(0, step) + step * np.arange(num_samples)
+        hits = np.minimum(np.searchsorted(cumulative_weights, targets, side='right'), len(positions) - 1)
+
+        chosen = []
+        taken = set()
+        for hit in hits:
+            i = int(hit)
+            skipped = 0
+            while not self.available[positions[i]] or i in taken:
+                i = (i + 1) % len(positions)
+                skipped += 1
+                if skipped >= len(positions):
+                    raise ValueError(f"Cannot take {num_samples} samples: too few unsampled grid points in {country} have more than {ag_thresh} agriculture.")
+            taken.add(i)
+            chosen.append(positions[i])
+
+        # Hit j goes to batch j % n_batches, so each batch is a systematic sample along the whole line
+        return np.array(chosen, dtype=np.int64).reshape(-1, n_batches).T.ravel()
+
+    def _weighted_sampler(self, country, ag_thresh, weight_column):
+        """
+        Return the Fenwick tree sampler over the rows of country with agriculture > ag_thresh and a positive
+        weight_column, with the weights of sampled rows set to 0.
+
+        The sampler is built once per (country, ag_thresh, weight_column). On later calls only the rows whose
+        availability changed since the last draw (e.g. sampled by another process) are updated, in O(log n) each.
+        """
+        key = (country, ag_thresh, weight_column)
+        if key not in self._weighted_samplers:
+            if weight_column not in self.grid.columns:
+                raise ValueError(f"The grid has no column {weight_column}. Load it with SampleGenerator(..., score_columns=['{weight_column}']).")
+
+            positions, agriculture = self._index.get(country, (np.empty(0, dtype=np.int64), np.empty(0)))
+            positions = positions[np.searchsorted(agriculture, ag_thresh, side='right'):]
+            weights = self.grid[weight_column].to_numpy(dtype=np.float64)[positions]
+            positive = np.nan_to_num(weights) > 0
+            positions, weights = positions[positive], weights[positive]
+            self._weighted_samplers[key] = (positions, weights, FenwickSampler(np.where(self.available[positions], weights, 0.0)))
+
+        positions, weights, sampler = self._weighted_samplers[key]
+        available = self.available[positions]
+        for i in np.flatnonzero(available != (sampler.weights > 0)):
+            sampler.set_weight(i, weights[i] if available[i] else 0.0)
+
+        return positions, sampler
+
+    def _draw_weighted(self, num_samples, country, ag_thresh, weight_column):
+        """
+        Draw num_samples rows one at a time with probability proportional to weight_column (successive sampling
+        without replacement). The position of each draw in the sequence of draws of the current sample_many call,
+        its probability given the draws before it and its approximate inclusion probability are kept so they can
+        be written out with the samples.
+        """
+        positions, sampler = self._weighted_sampler(country, ag_thresh, weight_column)
+        available = int((sampler.weights > 0).sum())
+        if num_samples > available:
+            raise ValueError(f"Cannot take {num_samples} samples: only {available} unsampled grid points in {country} have more than {ag_thresh} agriculture and a positive {weight_column}.")
+
+        inclusion_probabilities = sampler.inclusion_probabilities(num_samples)
+        drawn, draw_probabilities = sampler.draw(self.rng, num_samples)
+
+        # Drawn rows that end up unused (e.g. too close to another point) are put back by _weighted_sampler, but
+        # keep their place in the draw order
+        for i, draw_probability in zip(drawn, draw_probabilities):
+            self._draw_count += 1
+            self._draw_probabilities[positions[i]] = (self._draw_count, draw_probability, inclusion_probabilities[i])
+
+        return positions[drawn]
+
+    def _sync_with_ledger(self):
+        """
+        Mask out points that were added to the ledger (e.g. by another process) since it was last read.
+        """
+        self.ledger.refresh()
+        new_ids = np.asarray(self.ledger.ids[self._ledger_length:], dtype=np.int64)
+        self._ledger_length = len(self.ledger)
+
+        positions = np.searchsorted(self._sorted_ids, new_ids)
+        in_grid = positions < len(self._sorted_ids)
+        in_grid[in_grid] = self._sorted_ids[positions[in_grid]] == new_ids[in_grid]
+        self.available[self._id_order[positions[in_grid]]] = False
+
+    def sample(self, num_samples, country="All", ag_thresh=0.05, method="random", min_spacing_km=None, weight_column="agriculture"):
         """
         Sample a grid of points from the dataset without replacement.
 
@@ -67,47 +423,94 @@ class SampleGenerator:
             num_samples (int): Number of samples to take.
             country (str): Country name to filter by (default: "All").
             ag_thresh (float): Minimum agriculture proportion threshold.
+            method (str): "random" for a simple random sample, "grts" for a spatially balanced sample with
+                inclusion probability proportional to agriculture, or "weighted" to draw points one at a time with
+                probability proportional to weight_column.
+            min_spacing_km (float, optional): If given, no two points in the sample, and no point in the sample and
+                point sampled earlier in the group, are closer than this (e.g. 1.5 keeps 1 km survey boxes apart).
+            weight_column (str): Column of the grid to weight by when method="weighted" (e.g. a targeting model
+                probability loaded with score_columns). Points with a missing or zero weight are never drawn.
 
         Returns:
             pd.DataFrame: A DataFrame containing the sampled points.
         """
-        # Filter by agriculture threshold
-        sampled_grid = self.grid[self.grid['agriculture'] > ag_thresh]
+        return self.sample_many(1, num_samples, country=country, ag_thresh=ag_thresh, method=method, min_spacing_km=min_spacing_km, weight_column=weight_column)[0]
+
+    def sample_many(self, n_batches, batch_size, country="All", ag_thresh=0.05, method="random", min_spacing_km=None, weight_column="agriculture"):
+        """
+        Draw n_batches samples of batch_size points each in one pass, without replacement.
+
+        This produces the same files and id ranges as calling sample(batch_size, ...) n_batches times,
+        but draws all points at once and appends them to the ledger once.
 
-        # Filter by country
-        if country != "All":
-            sampled_grid = sampled_grid[sampled_grid['country'] == country]
+        Parameters:
+            n_batches (int): Number of samples (files) to create.
+            batch_size (int): Number of points in each sample.
+            country (str): Country name to filter by (default: "All").
+            ag_thresh (float): Minimum agriculture proportion threshold.
+            method (str): "random" or "grts" (see sample). With "grts" every batch is spatially balanced.
+            min_spacing_km (float, optional): Minimum distance between any two sampled points in the group (see sample).
+            weight_column (str): Column to weight by when method="weighted" (see sample).
 
-        # Sample the grid without replacement
-        samples = sampled_grid.sample(num_samples)
+        With method="weighted" the sample files get three extra columns for design-based estimates:
+            draw_order: The position of the draw among all draws of this call (1 = first). Samples are saved
+                sorted by location, so this is the only record of the draw order.
+            draw_prob: The probability with which the point was drawn, given the points drawn before it in the same
+                call. With draw_order this gives the Des Raj estimator, which is unbiased for successive sampling.
+            inclusion_prob: The probability that the point is among the points drawn by the call, from Rosén's
+                approximation (see FenwickSampler.inclusion_probabilities). It is close to, but not exactly, the
+                true inclusion probability, so Horvitz-Thompson estimates made with it are approximately unbiased.
+        With min_spacing_km, points rejected for being too close still take up a place in the draw order (so
+        draw_order can skip numbers) and the probabilities ignore the rejections, so both are approximate.
 
-        # Format for Collect
-        samples = samples[['id', 'latitude', 'longitude']].rename(columns={
-            'id': 'id', 'latitude': 'YCoordinate', 'longitude': 'XCoordinate'
-        })
+        Returns:
+            list[pd.DataFrame]: One DataFrame of sampled points per batch.
+        """
+        # Hold the ledger lock from the draw until the points are recorded, so that concurrent samplers
+        # neither draw the same points nor get overlapping sample numbers
+        with self.ledger.locked():
+            self._sync_with_ledger()
+            self._draw_probabilities = {}
+            self._draw_count = 0
+            positions = self._draw_spaced(n_batches * batch_size, country, ag_thresh, method=method, n_batches=n_batches, min_spacing_km=min_spacing_km, weight_column=weight_column)
 
-        # Sort the samples by latitude, then longitude
-        samples = samples.sort_values(by=['YCoordinate', 'XCoordinate'])
+            # Format for Collect, sorting each batch by latitude, then longitude
+            batches = []
+            for batch_positions in positions.reshape(n_batches, batch_size):
+                samples = self.grid.loc[batch_positions, ['id', 'latitude', 'longitude']].rename(columns={
+                    'id': 'id', 'latitude': 'YCoordinate', 'longitude': 'XCoordinate'
+                })
+                if method == "weighted":
+                    draws = np.array([self._draw_probabilities[position] for position in batch_positions])
+                    samples['draw_order'] = draws[:, 0].astype(np.int64)
+                    samples['draw_prob'] = draws[:, 1]
+                    samples['inclusion_prob'] = draws[:, 2]
+                batches.append(samples.sort_values(by=['YCoordinate', 'XCoordinate']))
 
-        # Add the list of chosen ids to the set of sampled points
-        self._update_sampled_points(samples['id'].tolist())
+            # Add the chosen ids to the ledger in one append
+            first_number, _ = self.ledger.append(np.concatenate([samples['id'].to_numpy() for samples in batches]))
+            self._ledger_length = len(self.ledger)
+            self.available[positions] = False
 
         # Save the sampled data
-        filename = f"sampling/samples/{self.sample_group_name}/{country}_{ag_thresh}_n_{len(self.sampled_points) - num_samples + 1}-{len(self.sampled_points)}.csv"
-        description = f"{num_samples} sampled grid points from {country} in areas with at least {ag_thresh} agriculture. Total samples in this sample group to date: {len(self.sampled_points)}"
-        save_data(samples, filename, description=description, file_format="csv")
+        for i, samples in enumerate(batches):
+            samples['id'] = samples['id'].map(format_id)
+            start = first_number + i * batch_size
+            end = start + batch_size - 1
+            filename = f"sampling/samples/{self.sample_group_name}/{country}_{ag_thresh}_n_{start}-{end}.csv"
+            description = f"{batch_size} sampled grid points from {country} in areas with at least {ag_thresh} agriculture. Total samples in this sample group to date: {end}"
+            save_data(samples, filename, description=description, file_format="csv")
 
-        return samples
+        return batches
 
 # Example Usage
 if __name__ == '__main__':
     # Initialize the sample generator with the grid file
-    grid_loc = get_data_root() + '/sampling/grid/combined/agriculture_grid.csv'
-    sampler = SampleGenerator(grid_loc, "random_sample")
+    grid_loc = get_data_root() + '/sampling/grid/combined/agriculture_grid.parquet'
+    sampler = SampleGenerator(grid_loc, "random_sample", countries=["Zambia"])
 
     # # Generate samples
     # samples = sampler.sample(50, country="Zambia", ag_thresh=0.05)
     # sampler.sample(25, country="Zambia", ag_thresh=0.05)
     # sampler.sample(50, country="All", ag_thresh=0.05)
-    for i in range(19):
-        sampler.sample(25, country="Zambia", ag_thresh=0.05)
\ No newline at end of file
+    sampler.sample_many(19, 25, country="Zambia", ag_thresh=0.05)
\ No newline at end of file
@@ -0,0 +1,264 @@
+# functions to compute elevation, slope and aspect from a DEM and add them to the 1km agriculture grid made by make_grid.py
+
+import sys
+import os
+
+# Add the project root to the system path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+# Now import the module
+from src.utils.utils import get_data_root, save_data, metadata_path
+from src.sampling.make_grid import agriculture_grid_transform, source_window
+
+import rasterio
+from rasterio.windows import Window
+import numpy as np
+import pandas as pd
+import pyproj
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+def horn_slope_aspect(dem, xres, yres):
+    """
+    Compute slope and aspect with Horn's 3x3 method.
+
+    Parameters:
+        dem (np.ndarray): Elevation in meters, with a one pixel halo on every side.
+        xres (float or np.ndarray): Pixel width in meters, either a scalar or one value per row (for geographic DEMs).
+        yres (float): Pixel height in meters.
+
+    Returns:
+        (np.ndarray, np.ndarray): Slope in degrees and aspect in degrees clockwise from north (the direction the
+        slope faces) for the pixels inside the halo. Both are NaN where a neighbour is missing; aspect is also
+        NaN on flat ground.
+    """
+    a, b, c = dem[:-2, :-2], dem[:-2, 1:-1], dem[:-2, 2:]
+    d, f = dem[1:-1, :-2], dem[1:-1, 2:]
+    g, h, i = dem[2:, :-2], dem[2:, 1:-1], dem[2:, 2:]
+
+    if np.ndim(xres):
+        xres = np.asarray(xres).reshape(-1, 1)
+
+    dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * xres)
+    dzdy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8 * yres)
+
+    slope = np.degrees(np.arctan(np.hypot(dzdx, dzdy)))
+    aspect = np.degrees(np.arctan2(dzdy, -dzdx))
+    aspect = np.where(aspect < 0, 90 - aspect, np.where(aspect > 90, 450 - aspect, 90 - aspect))
+    aspect[(dzdx == 0) & (dzdy == 0)] = np.nan
+
+    return slope, aspect
+
+def pixel_size_meters(transform, height, is_geographic):
+    """
+    Return the pixel width (per row for geographic rasters) and height in meters for a window of a raster.
+    """
+    if not is_geographic:
+        return abs(transform.a), abs(transform.e)
+
+    # Convert degrees to meters at the latitude of each row
+    row_lats = transform.f + (np.arange(height) + 0.5) * transform.e
+    return abs(transform.a) * 111320 * np.cos(np.radians(row_lats)), abs(transform.e) * 110540
+
+def terrain_block(dem, utm_crs, dst_transform, dst_shape):
+    """
+    Compute elevation, slope and aspect for one window of the agriculture grid.
+
+    The DEM is read with a one pixel halo around the part that covers the window, so slope and aspect at the
+    window edges use their true neighbours. Slope and aspect are computed at the DEM's resolution and then
+    averaged to the grid cells (aspect as a circular mean).
+
+    Returns:
+        dict: 'elevation', 'slope' and 'aspect' arrays of shape dst_shape (NaN where there is no DEM data).
+    """
+    layers = np.full((4, *dst_shape), np.nan, dtype=np.float32)
+    height, width = dst_shape
+    src_window = source_window(dem, utm_crs, rasterio.transform.array_bounds(height, width, dst_transform))
+
+    if src_window is not None:
+        # Read the DEM with a halo; pixels beyond the edge of the DEM are masked
+        halo_window = Window(src_window.col_off - 1, src_window.row_off - 1, src_window.width + 2, src_window.height + 2)
+        elevation = dem.read(1, window=halo_window, boundless=True, masked=True, out_dtype='float32').filled(np.nan)
+
+        src_transform = dem.window_transform(src_window)
+        xres, yres = pixel_size_meters(src_transform, src_window.height, dem.crs.is_geographic)
+        slope, aspect = horn_slope_aspect(elevation, xres, yres)
+
+        # Average aspect through its sine and cosine so that 359 and 1 degrees average to 0, not 180
+        aspect_rad = np.radians(aspect)
+        source = np.stack([elevation[1:-1, 1:-1], slope, np.sin(aspect_rad), np.cos(aspect_rad)]).astype(np.float32)
+
+        rasterio.warp.reproject(
+            source=source,
+            destination=layers,
+            src_transform=src_transform,
+            src_crs=dem.crs,
+            src_nodata=np.nan,
+            dst_transform=dst_transform,
+            dst_crs=utm_crs,
+            dst_nodata=np.nan,
+            resampling=rasterio.warp.Resampling.average
+        )
+
+    return {
+        'elevation': layers[0],
+        'slope': layers[1],
+        'aspect': (np.degrees(np.arctan2(layers[2], layers[3])) + 360) % 360,
+    }
+
+def grid_cells(df, utm_crs, transform):
+    """
+    Return the (row, col) of the resampled grid cell that each point of a tile's grid falls in.
+
+    Grid points are cell centers (see make_grid.grid_points), so projecting them back to UTM recovers their cell exactly.
+    """
+    transformer = pyproj.Transformer.from_crs("EPSG:4326", utm_crs, always_xy=True)
+    xs, ys = transformer.transform(df['longitude'].to_numpy(), df['latitude'].to_numpy())
+    cols = np.floor((xs - transform.c) / transform.a).astype(np.int64)
+    rows = np.floor((ys - transform.f) / transform.e).astype(np.int64)
+    return rows, cols
+
+def add_terrain(df, src_path, dem_path, res, window_size=256):
+    """
+    Add elevation (m), slope (degrees) and aspect (degrees clockwise from north) columns to a tile's grid.
+
+    Terrain is aggregated to the same res cells that make_grid built from the tile at src_path and joined onto
+    the grid by cell id (row * width + col in that tile's grid). The DEM is read one window of window_size x
+    window_size cells at a time, and only windows that contain grid points are read.
+
+    Parameters:
+        df (pd.DataFrame): Grid points of the tile (latitude, longitude, ...).
+        src_path (str): Path to the GFSAD tile the grid was made from.
+        dem_path (str): Path to the DEM (any CRS, elevation in meters). A VRT can be used to mosaic DEM tiles.
+        res (int): Resolution in meters the grid was made at.
+        window_size (int): Window size in grid cells.
+    """
+    with rasterio.open(src_path) as src:
+        utm_crs, transform, width, height = agriculture_grid_transform(src, res)
+
+    rows, cols = grid_cells(df, utm_crs, transform)
+    cell_ids = rows * width + cols
+
+    # Terrain for each cell id, filled in window by window
+    terrain = {name: np.full(len(df), np.nan, dtype=np.float32) for name in ['elevation', 'slope', 'aspect']}
+    window_ids = (rows // window_size) * (-(-width // window_size)) + cols // window_size
+
+    # Group the points by window
+    order = np.argsort(window_ids, kind='stable')
+    window_starts = np.flatnonzero(np.diff(window_ids[order], prepend=-1))
+
+    with rasterio.open(dem_path) as dem:
+        for in_window in np.split(order, window_starts[1:]) if len(order) else []:
+            row_off = int(rows[in_window[0]] // window_size) * window_size
+            col_off = int(cols[in_window[0]] // window_size) * window_size
+            window = Window(col_off, row_off, min(window_size, width - col_off), min(window_size, height - row_off))
+
+            block = terrain_block(dem, utm_crs, rasterio.windows.transform(window, transform), (window.height, window.width))
+
+            # Join on cell id within the window
+            local_ids = cell_ids[in_window] - (row_off * width + col_off)
+            local_rows, local_cols = local_ids // width, local_ids % width
+            for name, values in block.items():
+                terrain[name][in_window] = values[local_rows, local_cols]
+
+    df = df.copy()
+    for name, values in terrain.items():
+        df[name] = values
+
+    return df
+
+def process_terrain_tile(src_path, dem_path, res, window_size=256):
+    """
+    Add terrain to the grid saved for one tile by make_grid (sampling/grid/{tile}.csv) and save it to
+    sampling/grid/terrain/{tile}.csv. This is the unit of work for add_terrain_to_grid.
+    """
+    filename, _ = os.path.splitext(os.path.basename(src_path))
+    df = pd.read_csv(os.path.join(get_data_root(), f'sampling/grid/{filename}.csv'))
+    df = add_terrain(df, src_path, dem_path, res, window_size)
+    save_data(df, f'sampling/grid/terrain/{filename}.csv', description=f'Agriculture Data Resampled to {res}m Grid with elevation, slope and aspect', file_format='csv')
+    return df
+
+def add_terrain_to_grid(ag_data_loc, dem_path, res, window_size=256, n_workers=1, overwrite=False):
+    """
+    Add terrain to the grid of every tile in ag_data_loc, in parallel across n_workers processes if n_workers > 1.
+
+    Tiles that already have a complete sampling/grid/terrain/{tile}.csv output (with its metadata file, which
+    save_data writes last) are read back unless overwrite is True.
+
+    Returns:
+        pd.DataFrame: The combined grid with terrain, in the same tile order as make_grid.process_and_combine_ag_data.
+    """
+    files = sorted(f for f in os.listdir(ag_data_loc) if f.endswith('.tif'))
+
+    tile_dfs = {}
+    pending = []
+    for file in files:
+        filename, _ = os.path.splitext(file)
+        output_path = os.path.join(get_data_root(), f'sampling/grid/terrain/{filename}.csv')
+        if os.path.exists(output_path) and os.path.exists(metadata_path(output_path)) and not overwrite:
+            print(f"Terrain for {filename} already exists. Skipping.")
+            tile_dfs[file] = pd.read_csv(output_path)
+        else:
+            pending.append(file)
+
+    if n_workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                executor.submit(process_terrain_tile, os.path.join(ag_data_loc, file), dem_path, res, window_size): file
+                for file in pending
+            }
+            for future in as_completed(futures):
+                tile_dfs[futures[future]] = future.result()
+                print(f"Finished terrain for {futures[future]} ({len(tile_dfs)}/{len(files)} tiles)")
+    else:
+        for file in pending:
+            tile_dfs[file] = process_terrain_tile(os.path.join(ag_data_loc, file), dem_path, res, window_size)
+
+    return pd.concat([tile_dfs[file] for file in files], ignore_index=True)
+
+def make_synthetic_dem(path, bounds, pixel_size, gradient_east, gradient_north, base_elevation=1000):
+    """
+    Write a synthetic DEM in EPSG:4326 that is a plane rising gradient_east meters per meter to the east and
+    gradient_north meters per meter to the north. Used to test the terrain stage without real DEM data.
+    """
+    west, south, east, north = bounds
+    width = int(round((east - west) / pixel_size))
+    height = int(round((north - south) / pixel_size))
+    transform = rasterio.transform.from_origin(west, north, pixel_size, pixel_size)
+
+    lons = west + (np.arange(width) + 0.5) * pixel_size
+    lats = north - (np.arange(height) + 0.5) * pixel_size
+    x_m = (lons - west) * 111320 * np.cos(np.radians(lats))[:, None]
+    y_m = (lats - south)[:, None] * 110540
+    elevation = (base_elevation + gradient_east * x_m + gradient_north * y_m).astype(np.float32)
+
+    with rasterio.open(path, 'w', driver='GTiff', height=height, width=width, count=1, dtype='float32',
+                       crs='EPSG:4326', transform=transform, nodata=np.nan) as dst:
+        dst.write(elevation, 1)
+
+# Test the terrain stage on a synthetic cropland tile and a synthetic DEM with a known slope and aspect
+if __name__ == '__main__':
+    import tempfile
+    from src.sampling.make_grid import resample_agriculture_data
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bounds = (27.0, -15.5, 27.5, -15.0)
+
+        # Cropland everywhere in a 0.5 degree tile at ~30 m
+        src_path = os.path.join(tmp, 'tile.tif')
+        with rasterio.open(src_path, 'w', driver='GTiff', height=2000, width=2000, count=1, dtype='uint8', crs='EPSG:4326',
+                           transform=rasterio.transform.from_origin(bounds[0], bounds[3], 0.00025, 0.00025)) as dst:
+            dst.write(np.full((2000, 2000), 2, dtype=np.uint8), 1)
+
+        # A plane rising 5 m per 100 m to the east: slope = atan(0.05) ~ 2.86 degrees, facing west (270 degrees)
+        dem_path = os.path.join(tmp, 'dem.tif')
+        make_synthetic_dem(dem_path, bounds, 0.0008, gradient_east=0.05, gradient_north=0.0)
+
+        grid = resample_agriculture_data(src_path, 1000)
+        grid = add_terrain(grid, src_path, dem_path, 1000, window_size=16)
+
+        interior = grid.dropna()
+        print(f"{len(interior)} of {len(grid)} cells have terrain")
+        print(f"Slope: mean={interior['slope'].mean():.3f}, expected={np.degrees(np.arctan(0.05)):.3f}")
+        print(f"Aspect: mean={interior['aspect'].mean():.3f}, expected=270")
@@ -0,0 +1,112 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio.features
+from rasterio.transform import from_origin
+from functools import lru_cache
+
+# Code used in the rasterized index for cells that have to be resolved with an exact point-in-polygon test
+AMBIGUOUS = -2
+# Code used for points that are not inside any country
+NO_COUNTRY = -1
+
+def load_countries(path=None):
+    """
+    Load the country boundaries used throughout the project (Natural Earth low resolution by default).
+
+    Parameters:
+        path (str, optional): Path to a vector file of country polygons with a 'name' column.
+    """
+    if path is None:
+        path = gpd.datasets.get_path('naturalearth_lowres')
+    return gpd.read_file(path)
+
+class CountryIndex:
+    """
+    A country lookup index that is built once and then assigns countries to points with an array lookup.
+
+    The country polygons are rasterized to a regular lat/lon grid of country codes. Cells that touch a country
+    boundary (a shared border or the coast) are marked as ambiguous, as are points outside the extent of the grid.
+    Only points that fall in ambiguous cells are resolved with an exact point-in-polygon test against an STRtree,
+    so every other point is an O(1) array lookup.
+
+    Border rule: a point is assigned to the country whose polygon contains it, which gives the same result as a
+    left spatial join with predicate='within'. Points that are not inside any polygon (offshore, or exactly on a
+    shared border) get no country (None). If a point falls inside more than one polygon, the country listed first
+    in the country table is used.
+    """
+
+    def __init__(self, countries, resolution=0.05, bounds=None):
+        """
+        Build the index.
+
+        Parameters:
+            countries (gpd.GeoDataFrame): Country polygons in EPSG:4326 with a 'name' column.
+            resolution (float): Cell size of the rasterized index in degrees (default: 0.05, about 5 km).
+            bounds (tuple, optional): (west, south, east, north) extent of the rasterized index. Defaults to the
+                extent of all countries; points outside it are resolved exactly.
+        """
+        self.names = np.array(countries['name'], dtype=object)
+        self.geometries = np.asarray(countries.geometry.values)
+        self.tree = shapely.STRtree(self.geometries)
+        self.resolution = resolution
+
+        west, south, east, north = countries.total_bounds if bounds is None else bounds
+        self.west, self.north = west, north
+        self.width = int(np.ceil((east - west) / resolution))
+        self.height = int(np.ceil((north - south) / resolution))
+        transform = from_origin(west, north, resolution, resolution)
+
+        # Burn in each country by cell center
+        valid = [i for i, geom in enumerate(self.geometries) if geom is not None and not geom.is_empty]
+        self.codes = rasterio.features.rasterize(
+            ((self.geometries[i], i) for i in valid),
+            out_shape=(self.height, self.width), transform=transform, fill=NO_COUNTRY, dtype='int16'
+        )
+
+        # Any cell touched by a border or coastline is resolved exactly at lookup time
+        boundaries = rasterio.features.rasterize(
+            ((shapely.boundary(self.geometries[i]), 1) for i in valid),
+            out_shape=(self.height, self.width), transform=transform, fill=0, all_touched=True, dtype='uint8'
+        )
+        self.codes[boundaries == 1] = AMBIGUOUS
+
+    def lookup_codes(self, lons, lats):
+        """
+        Return the index of the country (in the country table) containing each point, or -1 if there is none.
+        """
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+
+        cols = np.floor((lons - self.west) / self.resolution).astype(np.int64)
+        rows = np.floor((self.north - lats) / self.resolution).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+
+        codes = np.full(lons.shape, AMBIGUOUS, dtype=np.int64)
+        codes[inside] = self.codes[rows[inside], cols[inside]]
+
+        # Resolve points on borders, coasts and outside the grid with an exact point-in-polygon test
+        ambiguous = np.nonzero(codes == AMBIGUOUS)[0]
+        if ambiguous.size:
+            points = shapely.points(lons[ambiguous], lats[ambiguous])
+            point_idx, country_idx = self.tree.query(points, predicate='within')
+            resolved = np.full(ambiguous.size, len(self.names), dtype=np.int64)
+            np.minimum.at(resolved, point_idx, country_idx)
+            resolved[resolved == len(self.names)] = NO_COUNTRY
+            codes[ambiguous] = resolved
+
+        return codes
+
+    def lookup(self, lons, lats):
+        """
+        Return the name of the country containing each point, or None if there is none.
+        """
+        codes = self.lookup_codes(lons, lats)
+        return np.append(self.names, None)[codes]  # code -1 maps to the trailing None
+
+@lru_cache(maxsize=None)
+def get_country_index(path=None, resolution=0.05):
+    """
+    Return the country index for the given boundaries, building it the first time it is requested in this process.
+    """
+    return CountryIndex(load_countries(path), resolution=resolution)
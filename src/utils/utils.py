@@ -8,6 +8,17 @@ import geopandas as gpd
 import rasterio
 import inspect
 import re
+import shutil
+import tempfile
+import hashlib
+import numpy as np
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 # Helper function to find the project root
 def find_project_root(current_path):
@@ -62,17 +73,142 @@ def get_data_root():
     else:
         return local_root
 
+@contextmanager
+def atomic_output(path):
+    """
+    Yield a unique temporary path in the same directory as path, and move it to path once the block has finished
+    without an error. Readers never see a partly written file, and a killed process only leaves a stray temporary
+    file behind, never a truncated output.
+
+    Parameters:
+        path (str): The final path of the file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+
+    # mkstemp creates the file readable by the owner only; give it the usual permissions
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)
+
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    Hold an exclusive lock on lock_path (created if needed) for the duration of the block, waiting for other
+    processes that hold it. Use it around read-modify-write updates of files that several processes share.
+
+    Parameters:
+        lock_path (str): The lock file, usually the shared file's path with ".lock" appended.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    with open(lock_path, "a+") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def metadata_path(output_path):
+    """
+    Return the path of the metadata file that save_data writes next to output_path. It is written after the data,
+    so an output without one was not saved completely.
+    """
+    return output_path.rsplit('.', 1)[0] + "_metadata.json"
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Return the SHA-256 hash of a file, reading it in chunks so large files do not have to fit in memory.
+
+    Parameters:
+        path (str): The file to hash.
+        chunk_size (int): Number of bytes to read at a time.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cached_file_hash(path, known=None):
+    """
+    Return the hash of a file with the modification time and size it was computed at, reusing the hash in known
+    when the file still has the same modification time and size, so unchanged files are not read again.
+
+    Parameters:
+        path (str): The file to hash.
+        known (dict, optional): A result of an earlier call for the same file ({"mtime": ..., "size": ...,
+            "hash": ...}).
+
+    Returns:
+        dict: {"mtime": ..., "size": ..., "hash": ...}, with the modification time in nanoseconds.
+    """
+    stat = os.stat(path)
+    if known and known.get("mtime") == stat.st_mtime_ns and known.get("size") == stat.st_size:
+        return known
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": file_hash(path)}
+
+def load_manifest(manifest_path, default=None):
+    """
+    Load a JSON manifest of what a set of outputs was built from.
+
+    Parameters:
+        manifest_path (str): The manifest file.
+        default (dict, optional): What to return if there is no manifest yet (an empty dict if not given).
+
+    Returns:
+        dict: The manifest.
+    """
+    if not os.path.exists(manifest_path):
+        return {} if default is None else default
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest_path, manifest):
+    """
+    Write a JSON manifest atomically, so an interrupted run cannot corrupt it.
+
+    Parameters:
+        manifest_path (str): The manifest file.
+        manifest (dict): The manifest.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    with atomic_output(manifest_path) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
 # Save data with metadata
-def save_data(data, output_path, description=None, file_format=None):
+def save_data(data, output_path, description=None, file_format=None, partition_cols=None, extra_metadata=None):
     """
     Save data to the specified output path in a flexible format, creating directories as needed,
     and optionally save metadata.
 
     Parameters:
-        data (any): Data to be saved (supports JSON, CSV, Pickle, YAML).
+        data (any): Data to be saved (supports JSON, CSV, Parquet, Pickle, YAML, and dicts of numpy arrays as mmap).
         output_path (str): Path where the data should be saved.
         description (str, optional): Description of the data.
-        file_format (str, optional): Format to save the data (json, csv, pickle, yaml). Inferred from file extension if not provided.
+        file_format (str, optional): Format to save the data (json, csv, parquet, mmap, pickle, yaml). Inferred from file extension if not provided.
+        partition_cols (list, optional): For parquet, columns to partition the dataset by. The output path is then a
+            directory with one subdirectory per value (e.g. agriculture_grid.parquet/country=Zambia/).
+        extra_metadata (dict, optional): Additional fields to record in the metadata file (e.g. links to related datasets).
     """
     output_path = get_data_root() + "/" + output_path
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -81,24 +217,57 @@ def save_data(data, output_path, description=None, file_format=None):
     if not file_format:
         file_format = output_path.split('.')[-1].lower()
 
-    # Save data based on the format
+    # Save data based on the format. Single files are written to a temporary file first (see atomic_output), so an
+    # interrupted run cannot leave a truncated file that looks complete.
     if file_format == 'json':
         # Check if the data is a GeoDataFrame
-        if isinstance(data, gpd.GeoDataFrame):
-            data.to_file(output_path, driver='GeoJSON')  # Save as GeoJSON
-        else:
-            with open(output_path, "w") as f:
-                json.dump(data, f)
+        with atomic_output(output_path) as tmp_path:
+            if isinstance(data, gpd.GeoDataFrame):
+                data.to_file(tmp_path, driver='GeoJSON')  # Save as GeoJSON
+            else:
+                with open(tmp_path, "w") as f:
+                    json.dump(data, f)
     elif file_format == 'csv':
         if isinstance(data, pd.DataFrame):
-            data.to_csv(output_path, index=False)
+            with atomic_output(output_path) as tmp_path:
+                data.to_csv(tmp_path, index=False)
         else:
             raise ValueError("Data must be a pandas DataFrame to save as CSV.")
+    elif file_format == 'parquet':
+        if isinstance(data, gpd.GeoDataFrame):
+            if partition_cols:
+                raise ValueError("Partitioned output is only supported for pandas DataFrames, not GeoDataFrames.")
+            with atomic_output(output_path) as tmp_path:
+                data.to_parquet(tmp_path, index=False)  # Save as GeoParquet
+        elif isinstance(data, pd.DataFrame):
+            # Replace rather than add to an existing partitioned dataset
+            if os.path.isdir(output_path):
+                shutil.rmtree(output_path)
+            data.to_parquet(output_path, index=False, partition_cols=partition_cols)
+        else:
+            raise ValueError("Data must be a pandas DataFrame to save as Parquet.")
+    elif file_format == 'mmap':
+        # A directory with one .npy file per array, which can be loaded with np.load(..., mmap_mode='r').
+        # The new directory is swapped in whole, so processes that have the old one mapped are not affected.
+        if not isinstance(data, dict):
+            raise ValueError("Data must be a dict of numpy arrays to save as memory-mapped arrays.")
+        tmp_path = output_path + ".tmp"
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, array in data.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.asarray(array))
+        if os.path.isdir(output_path):
+            os.replace(output_path, output_path + ".old")
+            os.replace(tmp_path, output_path)
+            shutil.rmtree(output_path + ".old")
+        else:
+            os.replace(tmp_path, output_path)
     elif file_format == 'pickle':
-        with open(output_path, "wb") as f:
+        with atomic_output(output_path) as tmp_path, open(tmp_path, "wb") as f:
             pickle.dump(data, f)
     elif file_format == 'yaml':
-        with open(output_path, "w") as f:
+        with atomic_output(output_path) as tmp_path, open(tmp_path, "w") as f:
             yaml.dump(data, f)
     elif file_format == 'tif':
         with rasterio.open(output_path, 'w', **data.meta) as dst:
@@ -124,10 +293,13 @@ def save_data(data, output_path, description=None, file_format=None):
         "file_format": file_format,
         "source": os.path.relpath(caller_script, start=find_project_root(os.getcwd()))  # Captures the file that created the data
     }
+    if partition_cols:
+        metadata["partition_cols"] = list(partition_cols)
+    if extra_metadata:
+        metadata.update(extra_metadata)
 
     # Save metadata alongside the data file
-    metadata_path = output_path.rsplit('.', 1)[0] + "_metadata.json"
-    with open(metadata_path, "w") as f:
+    with atomic_output(metadata_path(output_path)) as tmp_path, open(tmp_path, "w") as f:
         json.dump(metadata, f)
 
 # Generate the latest irrigation data from completed surveys